@@ -7,55 +7,60 @@
 from array import array
 
 def bit_width_per_value(value):
-    width = 0
-    while (2 ** width) <= value:
-        width += 1
-    return width if value > 0 else 1
+    return value.bit_length() if value > 0 else 1
 
 class Bitstream(object):
+    # Pending bits are collected in a single integer and only flushed into the byte buffer once enough
+    # have accumulated, so the shifting happens in C instead of once per bit.
+    flush_bits = 4096
+    __slots__ = ("buffer", "read_position", "accumulator", "accumulator_bits")
     def __init__(self):
-        self.buffer: list[int] = []
+        self.buffer: bytearray = bytearray()
         self.read_position = 0
-        self.write_position = 0
-        self.current_byte = 0
+        self.accumulator = 0
+        self.accumulator_bits = 0
     def append(self, count: int, value: int):
-        buffer = self.buffer
-        current_byte = self.current_byte
-        write_position = self.write_position
-        bit = count - 1
-        for _ in range(count):
-            current_byte = (current_byte << 1) | ((value >> (bit)) & 1)
-            bit -= 1
-            write_position += 1
-            if write_position == 8:
-                buffer.append(current_byte)
-                current_byte = 0
-                write_position = 0
-        self.write_position = write_position
-        self.current_byte = current_byte
-        self.buffer = buffer
+        self.accumulator = (self.accumulator << count) | (value & ((1 << count) - 1))
+        self.accumulator_bits += count
+        if self.accumulator_bits >= self.flush_bits:
+            self._flush_whole_bytes()
+    def append_byte(self, value: int):
+        if self.accumulator_bits & 7 == 0:
+            if self.accumulator_bits > 0:
+                self._flush_whole_bytes()
+            self.buffer.append(value & 0xFF)
+        else:
+            self.append(8, value)
+    def _flush_whole_bytes(self):
+        remaining_bits = self.accumulator_bits & 7
+        byte_count = self.accumulator_bits >> 3
+        if byte_count > 0:
+            self.buffer += (self.accumulator >> remaining_bits).to_bytes(byte_count, "big")
+            self.accumulator &= (1 << remaining_bits) - 1
+            self.accumulator_bits = remaining_bits
     def read(self, count: int) -> int:
-        value = 0
         position = self.read_position
         buffer = self.buffer
-        current_byte = self.current_byte
-        for _ in range(count):
-            if (position & 7) == 0:
-                if position // 8 >= len(buffer):
-                    break
-                else:
-                    current_byte = buffer[position // 8]
-            value = (value << 1) | ((current_byte >> (7 - (position & 7))) & 1)
-            position += 1
-        self.read_position = position
-        self.current_byte = current_byte
-        return value
+        count = max(min(count, len(buffer) * 8 - position), 0)
+        byte_index, bit_offset = divmod(position, 8)
+        byte_count = (bit_offset + count + 7) >> 3
+        chunk = int.from_bytes(buffer[byte_index:byte_index + byte_count], "big")
+        self.read_position = position + count
+        return (chunk >> ((byte_count << 3) - bit_offset - count)) & ((1 << count) - 1)
+    def read_byte(self) -> int:
+        position = self.read_position
+        if position & 7 == 0 and position < len(self.buffer) * 8:
+            self.read_position = position + 8
+            return self.buffer[position >> 3]
+        return self.read(8)
     def to_array(self) -> array:
-        if self.write_position > 0:
-            self.buffer.append(self.current_byte << (8 - self.write_position))
+        padding_bits = -self.accumulator_bits & 7
+        self.accumulator <<= padding_bits
+        self.accumulator_bits += padding_bits
+        self._flush_whole_bytes()
         return array('B', self.buffer)
     def from_array(self, data: array):
-        self.buffer = list(data)
+        self.buffer = bytearray(data)
         self.read_position = 0
-        self.current_byte = 0
-        self.write_position = 0
+        self.accumulator = 0
+        self.accumulator_bits = 0
@@ -4,13 +4,19 @@
 #  LICENSE.txt in this repository file going up the directory tree.
 #
 
+import hashlib
+import json
+import os
+import sys
+from collections import Counter
 from dataclasses import dataclass
+from functools import partial
+from itertools import groupby
 from typing import Union, Iterable, Optional, Callable
 from array import array
 
-from .utilities import common_prefix
 from .bitstream import Bitstream, bit_width_per_value
-from .process_controller import ProcessController
+from .process_controller import ProcessController, SharedBuffer
 
 def sanitize_buffer_address(buffer: Union[str, list, array, bytes], address_bits: int) -> int:
     """
@@ -26,6 +32,167 @@ def sanitize_buffer_address(buffer: Union[str, list, array, bytes], address_bits
     """
     return min(bit_width_per_value(len(buffer)), address_bits)
 
+class CompressedStream(object):
+    """
+    Compressed entries in structure-of-arrays layout. flags holds one byte per entry in order, 0 for a literal
+    and 1 for a reference. Literals and references are kept in their own typed arrays in the same order, for
+    LZSS a reference is an offset and a length, for RLE it is the repeated value and its count.
+
+    >>> stream = CompressedStream()
+    >>> stream.append_literal(97)
+    >>> stream.append_reference(-1, 3)
+    >>> len(stream), bytes(stream.flags), list(stream.literals), list(stream.values), list(stream.lengths)
+    (2, b'\\x00\\x01', [97], [-1], [3])
+    """
+    def __init__(self, literal_type: str = "B", value_type: str = "i", length_type: str = "i"):
+        self.flags = bytearray()
+        self.literals = array(literal_type)
+        self.values = array(value_type)
+        self.lengths = array(length_type)
+    def __len__(self):
+        return len(self.flags)
+    def append_literal(self, value: int):
+        self.flags.append(0)
+        self.literals.append(value)
+    def append_reference(self, value: int, length: int):
+        self.flags.append(1)
+        self.values.append(value)
+        self.lengths.append(length)
+    @classmethod
+    def from_entries(cls, entries: Iterable[Union[int, str, tuple[int, int]]], *types: str) -> 'CompressedStream':
+        """
+        Convert a list of literals and (value, length) tuples into a stream.
+
+        >>> stream = CompressedStream.from_entries([97, "b", (-2, 4), (99,)])
+        >>> bytes(stream.flags), list(stream.literals), list(stream.values), list(stream.lengths)
+        (b'\\x00\\x00\\x01\\x00', [97, 98, 99], [-2], [4])
+        """
+        stream = cls(*types)
+        for entry in entries:
+            # Producers only ever emit tuples for references, a class check is cheaper than isinstance
+            if entry.__class__ is tuple:
+                if len(entry) < 2:
+                    entry = entry[0]
+                else:
+                    stream.append_reference(*entry)
+                    continue
+            if entry.__class__ is str:
+                entry = ord(entry)
+            stream.append_literal(entry)
+        return stream
+
+# Hash chain parameters for the LZSS match finder. Chains are walked newest to oldest and cut off after
+# a fixed depth, so long runs of identical sequences do not walk the whole history.
+_lzss_hash_bits = 16
+_lzss_hash_size = 1 << _lzss_hash_bits
+_lzss_hash_multiplier = 0x9E3779B1
+_lzss_max_chain_depth = 256
+
+def _lzss_find_matches(data: bytes, minimum_backreference: int, max_length: int, history: int) -> tuple[CompressedStream, int, int]:
+    """
+    Greedy LZSS match finder on hash chains. It only works on locals and plain arrays, so it stays free of
+    any codec or statistics state.
+    :return: The compressed stream, the largest offset and the longest match
+
+    >>> stream, largest_offset, longest_match = _lzss_find_matches(b"abcabcabcabd", 2, 18, 4097)
+    >>> bytes(stream.flags), stream.literals.tobytes(), list(stream.values), list(stream.lengths)
+    (b'\\x00\\x00\\x00\\x01\\x00', b'abcd', [-3], [8])
+    >>> largest_offset, longest_match
+    (3, 8)
+
+    prev only covers the window, positions further back that share a slot are never taken as a match:
+
+    >>> period = hashlib.shake_128(b"window").digest(256)
+    >>> [_lzss_find_matches(period * 2, 2, 18, history)[1:] for history in (257, 129)]
+    [(256, 18), (87, 2)]
+
+    Chains are cut off after _lzss_max_chain_depth candidates, so a match further back in a busy bucket is missed:
+
+    >>> noise = hashlib.shake_128(b"chain").digest(4 * _lzss_max_chain_depth)
+    >>> def final_length(copies: int) -> int:
+    ...     data = b"abcdXYZW" + b"".join(b"abcd" + noise[4 * i:4 * i + 4] for i in range(copies)) + b"abcdXYZW"
+    ...     return _lzss_find_matches(data, 4, 19, 1 << 14)[0].lengths[-1]
+    >>> final_length(_lzss_max_chain_depth - 1), final_length(_lzss_max_chain_depth)
+    (8, 4)
+    """
+    stream = CompressedStream()
+    flags_append = stream.flags.append
+    literals_append = stream.literals.append
+    offsets_append = stream.values.append
+    lengths_append = stream.lengths.append
+    largest_offset = 0
+    longest_match = 0
+    max_chain_depth = _lzss_max_chain_depth
+    hash_shift = 32 - _lzss_hash_bits
+    hash_multiplier = _lzss_hash_multiplier
+    data_length = len(data)
+    view = memoryview(data)
+    # Hash chains as used by zlib, head holds the latest position for each hash bucket and prev links
+    # every position to the previous one that landed in the same bucket. prev is a ring covering the
+    # window, slots are only reused by positions whose predecessors are already out of reach.
+    head = array("i", [-1]) * _lzss_hash_size
+    prev_mask = (1 << history.bit_length()) - 1
+    prev = array("i", [-1]) * (prev_mask + 1)
+    # The key of the current position is rolled forward by one byte after literals and only rebuilt
+    # after a match skipped ahead.
+    key_mask = (1 << (8 * minimum_backreference)) - 1
+    key = int.from_bytes(view[:minimum_backreference], "big")
+    position = 0
+    while position < data_length:
+        if position + minimum_backreference > data_length:
+            flags_append(0)
+            literals_append(data[position])
+            position += 1
+            continue
+        bucket = ((key * hash_multiplier) & 0xFFFFFFFF) >> hash_shift
+        candidate = head[bucket]
+        head[bucket] = position
+        prev[position & prev_mask] = candidate
+
+        best_candidate = position
+        best_length = 0
+        oldest = max(position - history, -1)
+        depth = 0
+        limit = min(max_length, data_length - position)
+        while candidate > oldest and depth < max_chain_depth:
+            # Comparing forward from both positions also covers matches overlapping the current
+            # position, compare 8 bytes at a time and locate the first differing byte from the xor.
+            prefix = 0
+            while prefix + 8 <= limit:
+                difference = (int.from_bytes(view[candidate + prefix:candidate + prefix + 8], "little")
+                              ^ int.from_bytes(view[position + prefix:position + prefix + 8], "little"))
+                if difference:
+                    prefix += ((difference & -difference).bit_length() - 1) >> 3
+                    break
+                prefix += 8
+            else:
+                while prefix < limit and view[candidate + prefix] == view[position + prefix]:
+                    prefix += 1
+            if prefix > best_length:
+                best_length = prefix
+                best_candidate = candidate
+                if best_length >= max_length:
+                    break
+            candidate = prev[candidate & prev_mask]
+            depth += 1
+        if best_length >= minimum_backreference:
+            flags_append(1)
+            offsets_append(best_candidate - position)
+            lengths_append(best_length)
+            if position - best_candidate > largest_offset:
+                largest_offset = position - best_candidate
+            if best_length > longest_match:
+                longest_match = best_length
+            position += best_length
+            key = int.from_bytes(view[position:position + minimum_backreference], "big")
+        else:
+            flags_append(0)
+            literals_append(data[position])
+            position += 1
+            if position + minimum_backreference <= data_length:
+                key = ((key << 8) | view[position + minimum_backreference - 1]) & key_mask
+    return stream, largest_offset, longest_match
+
 @dataclass
 class LZSSEncodingStatistics:
     minimum_backreference: int = 1
@@ -41,22 +208,21 @@ class LZSSEncodingStatistics:
         self.max_window_bits = codec.max_window_bits
         self.max_length_bits = codec.max_length_bits
         self.overhead_bits = codec.size_bit_count + 4 + 4 + 2
-    def add_literal(self):
-        self.literals += 1
-    def add(self, offset, length):
-        self.references += 1
-        if offset > self.max_window:
-            if offset > (2 ** self.max_window_bits):
-                print(f"Offset {offset}, {length} exceeds {2 ** self.max_window_bits}")
-            self.max_window = offset
-        if length > self.max_length:
-            self.max_length = length
     def size(self):
         size = self.overhead_bits
         size += self.literals * 9
         size += self.references * (1 + self.max_window_bits + self.max_length_bits)
         return (size + 7) // 8
 class LZSSCodec(object):
+    """
+    >>> codec = LZSSCodec(8, 4)
+    >>> data = hashlib.shake_128(b"lzss").digest(64) * 3 + bytes(40)
+    >>> compressed, statistics = codec.compress(data)
+    >>> statistics.literals, statistics.references
+    (65, 11)
+    >>> codec.decompress(compressed) == data, codec.from_binary(codec.to_binary(compressed)) == data
+    (True, True)
+    """
     def __init__(self, max_window_bits, max_length_bits, size_bit_count = 22):
         """
 
@@ -78,86 +244,62 @@ class LZSSCodec(object):
             self.minimum_backreference = 3
         else:
             self.minimum_backreference = 4
-    def compress(self, data: bytes) -> tuple[list[Union[int, tuple[int, int]]], LZSSEncodingStatistics]:
-        candidate_cache = {}
-        results = []
-        minimum_backreference = self.minimum_backreference
-        max_length = minimum_backreference + (2 ** self.max_length_bits) - 1
-        history = (2 ** self.max_window_bits) + 1
+        self.max_reference_length = self.minimum_backreference + (1 << self.max_length_bits) - 1
+        self.history = (1 << self.max_window_bits) + 1
+    def compress(self, data: bytes) -> tuple[CompressedStream, LZSSEncodingStatistics]:
         statistics = LZSSEncodingStatistics(self)
-        position = 0
-        while position < len(data):
-            possible_slice = data[position:position + minimum_backreference]
-            candidate_cache_entry = candidate_cache.get(possible_slice, None)
-            if candidate_cache_entry is None:
-                candidate_cache[possible_slice] = [position]
-                results.append(data[position])
-                position += 1
-                statistics.add_literal()
-            else:
-                best_candidate = position
-                best_length = 0
-                oldest = position - history
-                new_candidates = []
-                for pos in candidate_cache_entry:
-                    if pos > oldest:
-                        new_candidates.append(pos)
-                        if best_length < max_length:
-                            prefix = common_prefix(data[pos:position], data[position:], max_length)
-                            if prefix > best_length:
-                                best_length = prefix
-                                best_candidate = pos
-                new_candidates.append(position)
-                candidate_cache[possible_slice] = new_candidates
-                if best_length >= minimum_backreference:
-                    results.append((best_candidate - position, best_length))
-                    statistics.add(position - best_candidate, best_length)
-                    position += best_length
+        stream, statistics.max_window, statistics.max_length = _lzss_find_matches(
+            data, self.minimum_backreference, self.max_reference_length, self.history)
+        assert statistics.max_window <= 1 << self.max_window_bits, f"Offset {statistics.max_window} exceeds {1 << self.max_window_bits}"
+        statistics.literals = len(stream.literals)
+        statistics.references = len(stream.values)
+        return stream, statistics
+    def decompress(self, compressed: Union[CompressedStream, Iterable[Union[int, tuple[int, int]]]]) -> bytes:
+        if not isinstance(compressed, CompressedStream):
+            compressed = CompressedStream.from_entries(compressed)
+        bytebuffer = bytearray()
+        literals = iter(compressed.literals)
+        offsets = iter(compressed.values)
+        lengths = iter(compressed.lengths)
+        for flag in compressed.flags:
+            if flag:
+                offset = next(offsets)
+                length = next(lengths)
+                source = len(bytebuffer) + offset
+                if length <= -offset:
+                    bytebuffer += bytebuffer[source:source + length]
                 else:
-                    results.append(data[position])
-                    position += 1
-                    statistics.add_literal()
-        return results, statistics
-    def decompress(self, compressed_buffer: Iterable[Union[int, tuple[int, int]]]) -> bytes:
-        bytebuffer = array("B")
-        for entry in compressed_buffer:
-            value = entry
-            if isinstance(entry, tuple) or isinstance(entry, list):
-                if len(entry) < 2:
-                    value = entry[0]
-                else:
-                    offset, length = entry
-                    for i in range(length):
-                        bytebuffer.append(bytebuffer[offset])
-                    continue
-
-            if isinstance(value, str):
-                value = ord(value)
-            bytebuffer.append(value)
+                    # The reference overlaps the data it produces, so it repeats the last -offset bytes.
+                    bytebuffer += (bytebuffer[source:] * (length // -offset + 1))[:length]
+            else:
+                bytebuffer.append(next(literals))
         return bytes(bytebuffer)
-    def to_binary(self, compressed_data: list[Union[int, tuple[int, int]]]) -> Optional[array]:
+    def to_binary(self, compressed: Union[CompressedStream, list[Union[int, tuple[int, int]]]]) -> Optional[array]:
+        if not isinstance(compressed, CompressedStream):
+            compressed = CompressedStream.from_entries(compressed)
         bitstream = Bitstream()
         bitstream.append(4, self.max_window_bits - 3)
         bitstream.append(4, self.max_length_bits - 1)
         bitstream.append(2, self.minimum_backreference - 1)
-        bitstream.append(self.size_bit_count, len(compressed_data))
-
-        for entry in compressed_data:
-            if isinstance(entry, tuple) or isinstance(entry, list):
-                if len(entry) < 2:
-                    value = entry[0]
-                else:
-                    (offset, length) = entry
-                    bitstream.append(1, 1)
-                    bitstream.append(self.max_window_bits, -offset - 1)
-                    bitstream.append(self.max_length_bits, length - self.minimum_backreference)
-                    continue
+        bitstream.append(self.size_bit_count, len(compressed))
+
+        # Flag and fields are written with a single append per entry
+        append = bitstream.append
+        reference_bits = 1 + self.max_window_bits + self.max_length_bits
+        reference_flag = 1 << (self.max_window_bits + self.max_length_bits)
+        window_mask = (1 << self.max_window_bits) - 1
+        length_mask = (1 << self.max_length_bits) - 1
+        length_bits = self.max_length_bits
+        minimum_backreference = self.minimum_backreference
+        literals = iter(compressed.literals)
+        offsets = iter(compressed.values)
+        lengths = iter(compressed.lengths)
+        for flag in compressed.flags:
+            if flag:
+                append(reference_bits, reference_flag | (((-next(offsets) - 1) & window_mask) << length_bits)
+                       | ((next(lengths) - minimum_backreference) & length_mask))
             else:
-                value = entry
-            if isinstance(value, str):
-                value = ord(value)
-            bitstream.append(1, 0)
-            bitstream.append(8, value)
+                append(9, next(literals) & 0xFF)
         return bitstream.to_array()
     def from_binary(self, data: array) -> bytes:
         bitstream = Bitstream()
@@ -166,19 +308,22 @@ class LZSSCodec(object):
         max_window_bits = bitstream.read(4) + 3
         length = bitstream.read(4) + 1
         minimum_backreference = bitstream.read(2) + 1
-        compressed_data = []
+        compressed = CompressedStream()
         count = bitstream.read(self.size_bit_count)
 
         # Compressed data
+        read = bitstream.read
+        read_byte = bitstream.read_byte
+        append_literal = compressed.append_literal
+        append_reference = compressed.append_reference
         for _ in range(count):
-            if bitstream.read(1):
-                offset = -bitstream.read(max_window_bits) - 1
-                count = bitstream.read(length) + minimum_backreference
-                compressed_data.append((offset, count))
+            if read(1):
+                offset = -read(max_window_bits) - 1
+                append_reference(offset, read(length) + minimum_backreference)
             else:
-                compressed_data.append(chr(bitstream.read(8)))
+                append_literal(read_byte())
 
-        return self.decompress(compressed_data)
+        return self.decompress(compressed)
 
 # We only support sentinel-based RLE encoding and flag encoding, we use the following as sentinel
 # value, although depending on the bit-width of the values, it may be truncated to a sub-value.
@@ -196,6 +341,23 @@ def rle_sentinel_for_bit_width(bit_width: int):
     '0x4c5d6e7f'
     """
     return _rle_sentinel & ((1 << bit_width) - 1)
+# Largest bit width, for which literal counts are tracked in a table covering all values.
+_rle_histogram_max_bits = 16
+# Values of these byte widths can be read by casting the data, as long as the platform is little endian.
+_rle_value_formats = {1: "B", 2: "H", 4: "I", 8: "Q"}
+def _rle_runs(values: Iterable[int], max_count: int) -> Iterable[tuple[int, int]]:
+    """
+    Split values into runs of equal values, that are at most max_count long.
+
+    >>> list(_rle_runs(b"aaabccccc", 4))
+    [(97, 3), (98, 1), (99, 4), (99, 1)]
+    """
+    for value, run in groupby(values):
+        count = len(list(run))
+        while count > max_count:
+            yield value, max_count
+            count -= max_count
+        yield value, count
 @dataclass
 class RLEncodingStatistics:
     literals: int = 0
@@ -208,24 +370,36 @@ class RLEncodingStatistics:
         self.use_sentinel = codec.bit_width & 3 == 0
         self.dynamic_sentinel = codec.dynamic_sentinel
         self.header_bits = 7 + 1 + codec.size_bits + codec.bit_width if self.use_sentinel else 0
-    def add_literal(self):
-        self.literals += 1
-    def add(self, length):
-        self.references += 1
-        if length > self.max_length:
-            self.max_length = length
-    def analyze_sentinel(self, compression_result: list[Union[int, tuple[int, int]]]):
+        # Literal counts per value, filled in while compressing to pick the dynamic sentinel. Wider values would
+        # need too large a table and partial bytes may hold values outside of it, those are counted once
+        # compression finished instead.
+        self.histogram: Optional[array] = None
+        if (self.use_sentinel and self.dynamic_sentinel and self.bit_width <= _rle_histogram_max_bits
+                and self.bit_width & 7 == 0):
+            self.histogram = array("Q", bytes(8 << self.bit_width))
+    def analyze_sentinel(self, compression_result: CompressedStream):
+        """
+        Pick the lowest unused value as sentinel, or else the least used value that was seen first.
+
+        >>> RLECodec(8).compress(bytes([2, 1, 5]))[1].sentinel
+        0
+        >>> [RLECodec(8).compress(bytes(range(255, -1, -1)) + data)[1].sentinel for data in (b"", bytes(range(128, 256)))]
+        [255, 127]
+        """
         if self.use_sentinel:
             if self.dynamic_sentinel:
                 # Let's figure out which glyph is used least in data and if there are any gaps. We only check
                 # values, that don't have a repeat yet, as those would not result in a lower encoding size.
                 self.sentinel = None
                 self.sentinel_count = 0
-                value_map = {}
-                for entry in compression_result:
-                    if isinstance(entry, tuple) or isinstance(entry, list):
-                        continue
-                    value_map[entry] = value_map.get(entry, 0) + 1
+                if self.histogram is not None:
+                    self.sentinel_count = min(self.histogram)
+                    self.sentinel = self.histogram.index(self.sentinel_count)
+                    if self.sentinel_count > 0:
+                        # Every value is used, ties go to the one seen first, like counting the literals does.
+                        self.sentinel = next(value for value in compression_result.literals if self.histogram[value] == self.sentinel_count)
+                    return
+                value_map = Counter(compression_result.literals)
                 for i in range(1 << self.bit_width):
                     if i not in value_map:
                         self.sentinel = i
@@ -238,11 +412,7 @@ class RLEncodingStatistics:
                 self.sentinel = rle_sentinel_for_bit_width(self.bit_width)
 
             if self.sentinel_count < 1:
-                for entry in compression_result:
-                    if isinstance(entry, tuple) or isinstance(entry, list):
-                        continue
-                    if entry == self.sentinel:
-                        self.sentinel_count += 1
+                self.sentinel_count = compression_result.literals.count(self.sentinel)
     def size(self):
         # This does not account for the sentinel value causing repeats
         bit_width = self.bit_width
@@ -260,62 +430,51 @@ class RLECodec(object):
         self.dynamic_sentinel = dynamic_sentinel
         self.use_sentinel = bit_width & 3 == 0
         self.minimum_loop = 3 if self.use_sentinel else 2
-    def compress(self, data: bytes) -> tuple[list[Union[int, tuple[int, int]]], RLEncodingStatistics]:
+        self.max_count = (1 << (self.bit_width + 1)) << (0 if self.use_sentinel else 1)
+    def compress(self, data: bytes) -> tuple[CompressedStream, RLEncodingStatistics]:
         byte_width = (self.bit_width + 7) // 8
-        result = []
+        result = CompressedStream("Q", "Q", "Q")
         statistics = RLEncodingStatistics(self)
-        position = 0
-        max_count = 1 << (self.bit_width + 1)
-        if not self.use_sentinel:
-            max_count <<= 1
-
-        def _get_value(data: bytes):
-            value = 0
-            for byte in range(min(byte_width, len(data))):
-                digit = data[byte] & 0xFF
-                if isinstance(digit, str):
-                    digit = ord(digit)
-                value = value | ((digit & 0xFF) << (byte * 8))
-            return value
-
-        while position < len(data):
-            value = _get_value(data[position:position + byte_width])
-            count = 1
-            position += byte_width
-            for i in range(position, len(data), byte_width):
-                if value != _get_value(data[i:i + byte_width]):
-                    break
-                count += 1
-                position += byte_width
-                if count >= max_count:
-                    break
+        max_count = self.max_count
+
+        view = memoryview(data)
+        data_length = len(data)
+        if byte_width in _rle_value_formats and data_length % byte_width == 0 and sys.byteorder == "little":
+            values = view.cast(_rle_value_formats[byte_width])
+        else:
+            values = (int.from_bytes(view[position:position + byte_width], "little") for position in range(0, data_length, byte_width))
+        histogram = statistics.histogram
+        for value, count in _rle_runs(values, max_count):
             if count >= self.minimum_loop:
-                result.append((value, count))
-                statistics.add(count)
+                result.append_reference(value, count)
             else:
-                for _ in range(count):
-                    result.append(value)
-                    statistics.add_literal()
+                result.flags.extend(bytes(count))
+                result.literals.extend([value] * count)
+                if histogram is not None:
+                    histogram[value] += count
+        statistics.literals = len(result.literals)
+        statistics.references = len(result.values)
+        statistics.max_length = max(result.lengths, default=0)
         statistics.analyze_sentinel(result)
         return result, statistics
-    def decompress(self, compressed: Iterable[Union[int, tuple[int, int]]]) -> bytes:
+    def decompress(self, compressed: Union[CompressedStream, Iterable[Union[int, tuple[int, int]]]]) -> bytes:
+        if not isinstance(compressed, CompressedStream):
+            compressed = CompressedStream.from_entries(compressed, "Q", "Q", "Q")
         byte_width = (self.bit_width + 7) // 8
-        bytebuffer = array("B")
-        for entry in compressed:
-            if isinstance(entry, tuple) or isinstance(entry, list):
-                (value, count) = entry
+        value_mask = (1 << (byte_width * 8)) - 1
+        bytebuffer = bytearray()
+        literals = iter(compressed.literals)
+        values = iter(compressed.values)
+        lengths = iter(compressed.lengths)
+        for flag in compressed.flags:
+            if flag:
+                bytebuffer += (next(values) & value_mask).to_bytes(byte_width, "little") * next(lengths)
             else:
-                value, count = entry, 1
-            if isinstance(value, str):
-                value = ord(value)
-            valuebuffer = array("B")
-            for i in range(byte_width):
-                valuebuffer.append(value  & 0xFF)
-                value >>= 8
-            for i in range(count):
-                bytebuffer.extend(valuebuffer)
+                bytebuffer += (next(literals) & value_mask).to_bytes(byte_width, "little")
         return bytes(bytebuffer)
-    def to_binary(self, compressed_data: list[Union[int, tuple[int, int]]], statistics: RLEncodingStatistics) -> Optional[array]:
+    def to_binary(self, compressed: Union[CompressedStream, list[Union[int, tuple[int, int]]]], statistics: RLEncodingStatistics) -> Optional[array]:
+        if not isinstance(compressed, CompressedStream):
+            compressed = CompressedStream.from_entries(compressed, "Q", "Q", "Q")
         bitstream = Bitstream()
         bitstream.append(7, self.bit_width - 1)
 
@@ -324,34 +483,40 @@ class RLECodec(object):
         # we are encoding ASCII, it is worth setting bit-width to 7 instead of 8, so we can
         # use the more beneficial flag encoding.
         bitstream.append(1, self.use_sentinel)
-        bitstream.append(self.size_bits, len(compressed_data) - 1)
+        bitstream.append(self.size_bits, len(compressed) - 1)
         # If use_sentinel is 1, expect another
         sentinel = 0
         if self.use_sentinel:
             sentinel = statistics.sentinel
             bitstream.append(self.bit_width, sentinel)
         count_width = self.bit_width + (0 if self.use_sentinel else 1)
+        # Byte values stay byte-aligned after the header, so they can skip the bit accumulator
+        append_value = bitstream.append_byte if self.bit_width == 8 else partial(bitstream.append, self.bit_width)
 
         def append_repeat(value, count):
             if self.use_sentinel:
-                bitstream.append(self.bit_width, sentinel)
-                bitstream.append(self.bit_width, value)
+                append_value(sentinel)
+                append_value(value)
+                append_value(count - 1)
             else:
                 bitstream.append(1, 1)
-                bitstream.append(self.bit_width, value)
-            bitstream.append(count_width, count - 1)
-
-        for entry in compressed_data:
-            if isinstance(entry, tuple) or isinstance(entry, list):
-                append_repeat(*entry)
-            elif self.use_sentinel and entry == sentinel:
+                append_value(value)
+                bitstream.append(count_width, count - 1)
+
+        literals = iter(compressed.literals)
+        values = iter(compressed.values)
+        lengths = iter(compressed.lengths)
+        for flag in compressed.flags:
+            if flag:
+                append_repeat(next(values), next(lengths))
+                continue
+            entry = next(literals)
+            if self.use_sentinel and entry == sentinel:
                 append_repeat(entry, 1)
             else:
                 if not self.use_sentinel:
                     bitstream.append(1, 0)
-                if isinstance(entry, str):
-                    entry = ord(entry)
-                bitstream.append(self.bit_width, entry)
+                append_value(entry)
 
         return bitstream.to_array()
     def from_binary(self, data: array) -> bytes:
@@ -365,25 +530,27 @@ class RLECodec(object):
         if use_sentinel:
             sentinel = bitstream.read(self.bit_width)
 
-        compressed_data = []
+        compressed = CompressedStream("Q", "Q", "Q")
+        read = bitstream.read
+        read_value = bitstream.read_byte if self.bit_width == 8 else partial(read, self.bit_width)
+        append_literal = compressed.append_literal
+        append_reference = compressed.append_reference
         for _ in range(count):
             if use_sentinel:
-                value = bitstream.read(self.bit_width)
+                value = read_value()
                 if value == sentinel:
-                    value = bitstream.read(self.bit_width)
-                    count = bitstream.read(self.bit_width) + 1
-                    compressed_data.append((value, count))
+                    value = read_value()
+                    append_reference(value, read_value() + 1)
                 else:
-                    compressed_data.append(value)
+                    append_literal(value)
             else:
-                repeat = bitstream.read(1)
-                value = bitstream.read(self.bit_width)
+                repeat = read(1)
+                value = read_value()
                 if repeat:
-                    count = bitstream.read(self.bit_width + 1) + 1
-                    compressed_data.append((value, count))
+                    append_reference(value, read(self.bit_width + 1) + 1)
                 else:
-                    compressed_data.append(value)
-        return compressed_data
+                    append_literal(value)
+        return self.decompress(compressed)
 CodecStatistics = LZSSEncodingStatistics
 
 @dataclass
@@ -391,13 +558,38 @@ class CompressionResult:
     window_bits: int
     length_bits: int
     size: int
-    compressed: Union[array, list[Union[int, tuple[int, int]]]]
+    compressed: Union[array, CompressedStream]
     statistics: Optional[CodecStatistics] = None
     pass_count: int = 0
     def __lt__(self, other):
         return self.size < other.size
     def __le__(self, other):
         return self.size <= other.size
+def _run_compression(codec: Callable, buffer: SharedBuffer, window_bits: int, length_bits: int) -> CompressionResult:
+    """
+    Compress the shared buffer with one window and length combination, runs in the worker processes.
+    """
+    data = buffer.view()
+    try:
+        compressed, statistics = codec(window_bits, length_bits).compress(data)
+    finally:
+        data.release()
+    return CompressionResult(window_bits, length_bits, statistics.size(), compressed, statistics)
+def _load_cache(path: str) -> dict[str, dict[str, int]]:
+    try:
+        with open(path, "r") as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+def _store_cache(path: str, key: str, window_bits: int, length_bits: int):
+    # Buffers may be compressed in several processes at once, so the cache is re-read right before it is written
+    # and replaced as a whole, an entry lost to a concurrent write is only searched for again.
+    cache = _load_cache(path)
+    cache[key] = {"window_bits": window_bits, "length_bits": length_bits}
+    temporary_path = f"{path}.{os.getpid()}"
+    with open(temporary_path, "w") as fd:
+        json.dump(cache, fd, indent=2, sort_keys=True)
+    os.replace(temporary_path, path)
 class CompressionRunner:
     """
     A runner for compressing buffers with different lookback and length combinations.
@@ -405,8 +597,18 @@ class CompressionRunner:
     codec: Callable
     controller: ProcessController
     buffer: bytes = b""
-    worse_allowed: int = 0
+    # Worse results tolerated along a series before it stops. Series often have local minima, since the minimum
+    # back-reference changes with the reference size.
+    worse_allowed: int = 5
+    # Number of combinations tried per round of the search, independent of the number of threads, so the result
+    # does not depend on how many workers are available.
+    search_width: int = 6
+    # Buffers smaller than this are searched in the calling process, starting the workers takes longer than the
+    # whole search on them.
+    inline_size: int = 16 << 10
     print_progress: bool = False
+    # JSON file keeping the best combination found for a buffer, so the search is skipped for unchanged buffers.
+    cache_path: Optional[str] = None
     def __init__(self, codec: Callable, buffer: bytes, max_window_bits: int = 16, max_length_bits = None, max_threads: int = 8):
         """
         Initialize the runner with a codec, buffer and parameters for the compression.
@@ -418,11 +620,49 @@ class CompressionRunner:
         """
         self.codec = codec
         self.buffer = buffer
-        self.controller = ProcessController(max_threads, True)
+        self.controller = ProcessController(max_threads if len(buffer) >= self.inline_size else 1)
+        self.controller.register("compress", _run_compression)
         self.max_window_bits = sanitize_buffer_address(buffer, max_window_bits)
         self.max_length_bits = sanitize_buffer_address(buffer, max_length_bits) if max_length_bits is not None else self.max_window_bits
-        self.results = self.controller.manager.list()
+        self.results: list[CompressionResult] = []
     def find_best_compression(self) -> tuple[array, CompressionResult]:
+        """
+        Find the best compression for a buffer, see _find_best_compression. The buffer is placed in shared memory
+        for the duration of the search, so the workers can read it without it being sent along with every task.
+
+        With a cache_path, a combination found before for the same buffer and limits is used right away, the
+        result then has a pass_count of 0.
+
+        >>> data = bytes(b"aaaaabbbcdef"[value % 12] for value in hashlib.shake_128(b"lzss").digest(CompressionRunner.inline_size))
+        >>> results = [CompressionRunner(LZSSCodec, data, 12, None, threads).find_best_compression()[1] for threads in (1, 2)]
+        >>> [(result.window_bits, result.length_bits, result.size, result.pass_count) for result in results]
+        [(11, 2, 7666, 22), (11, 2, 7666, 22)]
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as directory:
+        ...     def cached_search():
+        ...         runner = CompressionRunner(LZSSCodec, data, 12, None, 1)
+        ...         runner.cache_path = os.path.join(directory, "cache.json")
+        ...         return runner.find_best_compression()
+        ...     (searched, searched_result), (cached, cached_result) = cached_search(), cached_search()
+        >>> searched == cached, searched_result.pass_count, cached_result.pass_count, cached_result.window_bits, cached_result.length_bits
+        (True, 22, 0, 11, 2)
+        """
+        if self.cache_path is not None:
+            key = f"{self.codec.__name__}_{self.max_window_bits}_{self.max_length_bits}_{hashlib.sha1(self.buffer).hexdigest()}"
+            cached = _load_cache(self.cache_path).get(key)
+            if cached is not None:
+                codec = self.codec(cached["window_bits"], cached["length_bits"])
+                compressed, statistics = codec.compress(self.buffer)
+                return codec.to_binary(compressed), CompressionResult(cached["window_bits"], cached["length_bits"], statistics.size(), compressed, statistics)
+        self.shared_buffer = self.controller.publish("buffer", self.buffer)
+        try:
+            binary, result = self._find_best_compression()
+        finally:
+            self.controller.join_all()
+        if self.cache_path is not None:
+            _store_cache(self.cache_path, key, result.window_bits, result.length_bits)
+        return binary, result
+    def _find_best_compression(self) -> tuple[array, CompressionResult]:
         """
         Find the best compression for a buffer by trying different lookback and length combinations.
 
@@ -431,6 +671,9 @@ class CompressionRunner:
         try to decrease lookback and observe results improving until the suitable buffer size, before they start to
         deteriorate. Assume there may be a few worse results for lookback, that may still result in better outcomes
         with different lengths, so include them as well.
+
+        Combinations are tried in rounds of search_width, the combinations tried and the result therefore only
+        depend on the buffer and not on the number of threads.
         """
         def find_reversion(series, max_key: int, get_key: Callable[[CompressionResult], int]) -> tuple[Optional[int], int]:
             lowest_size = float("inf")
@@ -452,100 +695,51 @@ class CompressionRunner:
                     lowest_size = result.size
                 expected_key -= 1
             return lowest_size_key, allowed_worse
-        def join_finished():
-            if self.controller.max_threads == 1:
-                print(".", end="")
-                return 1
-            count = self.controller.join_finished()
+        def tried(window_bits: int, length_bits: int) -> bool:
+            return any(r.window_bits == window_bits and r.length_bits == length_bits for r in self.results)
+        def run_round(combinations: Iterable[tuple[int, int]]):
+            # Every combination of a round is finished before the next round is chosen, the pool size only decides
+            # how many of them run at once.
+            futures = [self.controller.start("compress", (self.codec, self.shared_buffer, window_bits, length_bits))
+                       for window_bits, length_bits in dict.fromkeys(combinations)
+                       if 2 < window_bits <= self.max_window_bits and 0 < length_bits <= self.max_length_bits
+                       and not tried(window_bits, length_bits)]
+            for future in futures:
+                self.results.append(future.result())
             if self.print_progress:
-                print("." * count, end="")
-            return count
-        def best_result():
-            return None if len(self.results) < 1 else min(self.results, key=lambda x: x.size)
-        def filter_for_threads(iterable: Iterable):
-            for value in iterable:
-                if self.controller.available() > 0:
-                    yield value
-                    if self.controller.max_threads == 1:
-                        return
-                else:
-                    return
-        def compress(window_bits: int, length_bits: int):
-            def run_compression(window_bits: int, length: int):
-                codec = self.codec(window_bits, length)
-                comp, statistics = codec.compress(self.buffer)
-                result = CompressionResult(window_bits, length, statistics.size(), comp, statistics)
-                self.results.append(result)
-
-            if (next((r for r in self.results if r.window_bits == window_bits and r.length_bits == length_bits), False) == False
-                    and 2 < window_bits <= self.max_window_bits and 0 < length_bits <= self.max_length_bits):
-                self.controller.start(run_compression, (window_bits, length_bits))
-        def finished(condition):
-            return ((self.controller.max_threads > 1 and self.controller.running() < 1)
-                    or (self.controller.max_threads == 1 and condition))
-        # Instead of just starting to iterate, try to split the first series between window_bits and length
+                print("." * len(futures), end="")
+        def search_series(series_filter: Callable[[CompressionResult], bool], get_key: Callable[[CompressionResult], int],
+                          get_combination: Callable[[int], tuple[int, int]], max_key: int, min_key: int, key: int) -> int:
+            # Walk the series down from key in rounds, until it turns worse or runs out of keys.
+            while True:
+                series = [r for r in self.results if series_filter(r)]
+                lowest_key, allowed_worse = find_reversion(series, max_key, get_key)
+                if (lowest_key is not None and allowed_worse < 0) or key < min_key:
+                    return lowest_key
+                run_round(get_combination(k) for k in range(key, max(key - self.search_width, min_key - 1), -1))
+                key -= self.search_width
+
+        # Instead of just starting to iterate, try to split the first round between window_bits and length
         # results, it is highly likely that this is enough to find close to the best result already.
-        initial_window_bits_count = (self.controller.max_threads + 1) // 2
-        start_window_bits = self.max_window_bits - initial_window_bits_count
-        start_length_bits = self.max_length_bits - self.controller.max_threads + initial_window_bits_count - 1
-
-        for window_bits in range(self.max_window_bits, start_window_bits, -1):
-            compress(window_bits, self.max_length_bits)
-        for length_bits in range(self.max_length_bits - 1, start_length_bits, -1):
-            compress(self.max_window_bits, length_bits)
-
-        window_bits = start_window_bits
-        lowest_window_bits = self.max_window_bits
-        while True:
-            if join_finished() > 0:
-                series = [r for r in self.results if r.length_bits == self.max_length_bits]
-                lowest_window_bits, allowed_worse = find_reversion(series, self.max_window_bits, lambda r: r.window_bits)
-                if lowest_window_bits is not None and allowed_worse < 0:
-                    break
-            for window_bits in filter_for_threads(range(window_bits, 2, -1)):
-                compress(window_bits, self.max_length_bits)
-                window_bits -= 1
-            if finished(window_bits < 3):
-                if self.controller.max_threads == 1:
-                    series = [r for r in self.results if r.length_bits == self.max_length_bits]
-                    lowest_window_bits, _ = find_reversion(series, self.max_window_bits, lambda r: r.window_bits)
-                break
-
-        # We could do something fancy here to get closer to our original value, but we already ran max_threads / 2
-        # iterations with max_window_bits, to get the best results, we need to complete that series.
-        length_bits = min(r.length_bits for r in self.results if r.window_bits == self.max_window_bits)
-        lowest_length_bits = 1
-
-        while True:
-            if join_finished() > 0:
-                series = [r for r in self.results if r.window_bits == self.max_window_bits]
-                lowest_length_bits, allowed_worse = find_reversion(series, self.max_length_bits, lambda r: r.length_bits)
-                if lowest_length_bits is not None and allowed_worse < 0:
-                    break
-            for length_bits in filter_for_threads(range(length_bits, 0, -1)):
-                compress(self.max_window_bits, length_bits)
-                length_bits -= 1
-            if finished(length_bits < 1):
-                if self.controller.max_threads == 1:
-                    series = [r for r in self.results if r.window_bits == self.max_window_bits]
-                    lowest_length_bits, _ = find_reversion(series, self.max_length_bits, lambda r: r.length_bits)
-                break
-
-        additional_combinations = []
-        for window_bits in range(lowest_window_bits - 1, lowest_window_bits + 1):
-            if (window_bits > 2) and (window_bits <= self.max_window_bits):
-                for length_bits in range(lowest_length_bits - 1, lowest_length_bits + 1):
-                    if (length_bits > 0) and (length_bits <= self.max_length_bits):
-                        additional_combinations.append((window_bits, length_bits))
-        while True:
-            join_finished()
-            for window_bits, length_bits in filter_for_threads(additional_combinations):
-                compress(window_bits, length_bits)
-                additional_combinations.remove((window_bits, length_bits))
-            if finished(len(additional_combinations) < 1):
-                break
-
-        result = best_result()
+        initial_window_bits_count = (self.search_width + 1) // 2
+        initial_length_bits_count = self.search_width - initial_window_bits_count
+        run_round([(window_bits, self.max_length_bits) for window_bits in range(self.max_window_bits, self.max_window_bits - initial_window_bits_count, -1)]
+                  + [(self.max_window_bits, length_bits) for length_bits in range(self.max_length_bits - 1, self.max_length_bits - 1 - initial_length_bits_count, -1)])
+
+        lowest_window_bits = search_series(lambda r: r.length_bits == self.max_length_bits, lambda r: r.window_bits,
+                                           lambda window_bits: (window_bits, self.max_length_bits),
+                                           self.max_window_bits, 3, self.max_window_bits - initial_window_bits_count)
+        # The length series with max_window_bits was already started in the first round, to get the best results,
+        # we need to complete that series.
+        lowest_length_bits = search_series(lambda r: r.window_bits == self.max_window_bits, lambda r: r.length_bits,
+                                           lambda length_bits: (self.max_window_bits, length_bits),
+                                           self.max_length_bits, 1, self.max_length_bits - 1 - initial_length_bits_count)
+
+        run_round((window_bits, length_bits)
+                  for window_bits in range(lowest_window_bits - 1, lowest_window_bits + 1)
+                  for length_bits in range(lowest_length_bits - 1, lowest_length_bits + 1))
+
+        result = min(self.results, key=lambda x: x.size)
         result.pass_count = len(self.results)
         return self.codec(result.window_bits, result.length_bits).to_binary(result.compressed), result
 
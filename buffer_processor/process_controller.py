@@ -4,61 +4,231 @@
 #  LICENSE.txt in this repository file going up the directory tree.
 #
 
+import concurrent.futures
 import multiprocessing
+import os
+import queue
+import signal
 import sys
+import threading
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Optional, Callable, Union
+
+# Shared memory blocks attached in this process, published ones in the main process and attached ones in workers.
+_attached_buffers: dict[str, shared_memory.SharedMemory] = {}
+@dataclass(frozen=True)
+class SharedBuffer:
+    """
+    Handle to a buffer published by a ProcessController, only the name and size are sent along with a task.
+    """
+    name: str
+    size: int
+    def view(self) -> memoryview:
+        """
+        Attach the buffer on first use in this process and return a view of it, release the view when done.
+        """
+        if self.name not in _attached_buffers:
+            _attached_buffers[self.name] = shared_memory.SharedMemory(name=self.name)
+        return _attached_buffers[self.name].buf[:self.size]
+
+# Targets registered with a ProcessController, sent to every worker once when it starts.
+_registered_targets: dict[str, Callable] = {}
+def _initialize_worker(targets: dict[str, Callable], initializer: Optional[Callable], initargs: tuple, worker_pids):
+    # Workers report themselves, so kill_all can stop them without reaching into the executor.
+    worker_pids.put(os.getpid())
+    _registered_targets.update(targets)
+    if initializer is not None:
+        initializer(*initargs)
+def _run_registered(name: str, *args):
+    return _registered_targets[name](*args)
 
 class ProcessController:
-    def __init__(self, max_threads: int = float("inf"), use_main_process = False):
-        self.processes: list[multiprocessing.Process] = []
+    """
+    Runs tasks in worker processes, at most max_threads at once and max_queued more waiting in the executor.
+
+    >>> controller = ProcessController(2, max_queued=1)
+    >>> controller.register("divmod", divmod)
+    >>> controller.available()
+    3
+    >>> futures, most_running = [], 0
+    >>> for value in range(8):
+    ...     futures.append(controller.start("divmod", (value, 3)))
+    ...     most_running = max(most_running, controller.running())
+    >>> [future.result() for future in futures][-2:], most_running <= 3
+    ([(2, 0), (2, 1)], True)
+    >>> controller.start(divmod, (7, 3)).result(), controller.join_finished() > 0
+    ((2, 1), True)
+
+    A failing task only fails its future, the workers keep running the next tasks, also when run inline.
+
+    >>> type(controller.start(int, ("x",)).exception()).__name__, controller.start(int, ("7",)).result()
+    ('ValueError', 7)
+    >>> type(ProcessController(1).start(int, ("x",)).exception()).__name__
+    'ValueError'
+
+    Published buffers are released along with the workers.
+
+    >>> shared = controller.publish("data", b"abc")
+    >>> bytes(shared.view()), shared.size
+    (b'abc', 3)
+    >>> controller.join_all() > 0, controller.published, shared.name in _attached_buffers
+    (True, {}, False)
+    >>> shared_memory.SharedMemory(name=shared.name)  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    FileNotFoundError: ...
+
+    Running tasks are stopped by killing the workers, the controller starts new ones when used again.
+
+    >>> import time
+    >>> sleeping = [controller.start(time.sleep, (60,)) for _ in range(2)]
+    >>> started = time.monotonic()
+    >>> controller.kill_all(), time.monotonic() - started < 30
+    (2, True)
+    >>> controller.start("divmod", (7, 3)).result(), controller.join_all()
+    ((2, 1), 1)
+    """
+    # Workers are started from a forkserver where available, so they do not inherit the whole state of a
+    # parent that may have grown large, and the choice stays local to the controllers.
+    start_method: str = "spawn" if sys.platform in ("win32", "darwin") else "forkserver"
+    booted: bool = False
+    boot_lock = threading.Lock()
+    # Seconds kill_all waits for a worker to report, workers report before they run any task.
+    report_timeout: float = 10
+    def __init__(self, max_threads: int = float("inf"), initializer: Optional[Callable] = None, initargs: tuple = (), max_queued: int = 0):
+        self.futures: set[concurrent.futures.Future] = set()
         self.max_threads: int = max_threads
-        self.use_main_process = True
-        self.main_running = False
-        self.manager: multiprocessing.Manager = multiprocessing.Manager()
+        # Tasks accepted beyond the worker count wait in the executor, so a worker finishing early picks up the
+        # next one right away instead of waiting for the main process to submit it.
+        self.max_queued: int = max_queued
+        # Runs once in every worker process, so read-only state can be set up there instead of being sent
+        # along with every task. It does not run in the main process.
+        self.initializer: Optional[Callable] = initializer
+        self.initargs: tuple = initargs
+        self.executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self.worker_pids = None
+        self.context = multiprocessing.get_context(self.start_method)
+        self.published: dict[str, SharedBuffer] = {}
+        self.targets: dict[str, Callable] = {}
+        # Futures are dropped from the running set by their done callback, which runs on the executor's thread,
+        # waiting for a finished task then blocks on this condition instead of polling. Finished tasks keep their
+        # slot until join_finished reports them, so callers always see every result before a slot is reused.
+        self.condition = threading.Condition()
+        self.finished_count = 0
+    def publish(self, name: str, data: Union[bytes, bytearray, memoryview]) -> SharedBuffer:
+        """
+        Copy read-only task input into shared memory once, pass the returned handle to tasks instead of the data.
+        The buffer is released by unpublish, join_all or kill_all.
+        """
+        self.unpublish(name)
+        block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        block.buf[:len(data)] = data
+        _attached_buffers[block.name] = block
+        self.published[name] = SharedBuffer(block.name, len(data))
+        return self.published[name]
+    def unpublish(self, name: str):
+        if name in self.published:
+            block = _attached_buffers.pop(self.published.pop(name).name)
+            block.close()
+            block.unlink()
     def available(self):
-        return self.max_threads - len(self.processes) - (1 if self.main_running else 0)
+        return self.max_threads + self.max_queued - self.running()
     def running(self):
-        return len(self.processes) + (1 if self.main_running else 0)
-    def start(self, target, args):
+        return len(self.futures) + self.finished_count
+    def register(self, name: str, target: Callable):
+        """
+        Register a target, that start accepts by name, so only the name is sent along with every task.
+        """
+        if self.executor is not None:
+            raise Exception(f"Target '{name}' has to be registered before any workers are started")
+        self.targets[name] = target
+    def start(self, target: Union[str, Callable], args) -> concurrent.futures.Future:
         while self.available() < 1:
-            for process in self.processes:
-                if not process.is_alive():
-                    self.processes.remove(process)
-                    break
-        if self.available() == 1 and self.use_main_process:
-            self.main_running = True
-            target(*args)
-            self.main_running = False
-        else:
-            process = multiprocessing.Process(target=target, args=args)
-            process.start()
-            self.processes.append(process)
+            self.join_finished()
+        if isinstance(target, str):
+            target, args = (self.targets[target], args) if self.max_threads == 1 else (_run_registered, (target, *args))
+        if self.max_threads == 1:
+            # A single thread runs everything in the main process, without starting any workers.
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(target(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        if self.executor is None:
+            # Workers are kept alive between tasks.
+            max_workers = None if self.max_threads == float("inf") else int(self.max_threads)
+            self.worker_pids = self.context.Queue()
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=self.context, initializer=_initialize_worker, initargs=(self.targets, self.initializer, self.initargs, self.worker_pids))
+        future = self.executor.submit(target, *args)
+        with self.condition:
+            self.futures.add(future)
+        future.add_done_callback(self._finished)
+        return future
+    def _finished(self, future: concurrent.futures.Future):
+        with self.condition:
+            # Callbacks may still arrive after join_all or kill_all let go of their futures.
+            if future in self.futures:
+                self.futures.remove(future)
+                self.finished_count += 1
+            self.condition.notify_all()
     def join_finished(self):
-        count = 0
-        for process in self.processes:
-            if not process.is_alive():
-                process.join()
-                self.processes.remove(process)
-                count += 1
-        return count + (1 if self.main_running else 0)
+        with self.condition:
+            self.condition.wait_for(lambda: self.finished_count > 0 or len(self.futures) < 1)
+            count, self.finished_count = self.finished_count, 0
+        return count
     def join_all(self):
-        count = 0
-        for process in self.processes:
-            process.join()
-            self.processes.remove(process)
-            count += 1
+        with self.condition:
+            futures = set(self.futures)
+            count = self.running()
+        concurrent.futures.wait(futures)
+        with self.condition:
+            self.futures = set()
+            self.finished_count = 0
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.worker_pids.close()
+            self.worker_pids = None
+            self.executor = None
+        for name in list(self.published):
+            self.unpublish(name)
         return count
     def kill_all(self):
-        count = 0
-        for process in self.processes:
-            process.kill()
-            self.processes.remove(process)
-            count += 1
+        with self.condition:
+            count = self.running()
+            self.futures = set()
+            self.finished_count = 0
+        if self.executor is not None:
+            # The executor has no public way to stop running tasks, so workers are killed by the pid they reported.
+            # Killing one breaks the pool and the executor then terminates the others, including those still
+            # starting, so only the first report has to be waited for.
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            pids = []
+            try:
+                pids.append(self.worker_pids.get(timeout=self.report_timeout))
+                while True:
+                    pids.append(self.worker_pids.get_nowait())
+            except queue.Empty:
+                pass
+            for pid in pids:
+                try:
+                    os.kill(pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+                except ProcessLookupError:
+                    pass
+            self.executor.shutdown(wait=True)
+            self.worker_pids.close()
+            self.worker_pids = None
+            self.executor = None
+        for name in list(self.published):
+            self.unpublish(name)
         return count
-    @staticmethod
-    def boot():
-        multiprocessing.freeze_support()
-        if sys.platform == "win32":
-            multiprocessing.set_start_method("spawn")
-        else:
-            multiprocessing.set_start_method("fork")
-        ProcessController.start_method_set = True
+    @classmethod
+    def boot(cls):
+        with cls.boot_lock:
+            if not cls.booted:
+                multiprocessing.freeze_support()
+                cls.booted = True
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -4,16 +4,20 @@
 #  LICENSE.txt in this repository file going up the directory tree.
 #
 
+import functools
 import os.path
 import re
 import sys
 from dataclasses import dataclass
+from types import MappingProxyType
 from typing import Optional, Union
 
-data_widths = {"uint8_t": 1, "uint16_t": 2, "uint32_t": 4, "uint64_t": 8,
-               "int8_t": 1, "int16_t": 2, "int32_t": 4, "int64_t": 8,
-               "float": 4, "double": 8, "bool": 1, "char": 1,
-               int: 8, float: 8, bool: 1}
+_c_data_widths = MappingProxyType({"uint8_t": 1, "uint16_t": 2, "uint32_t": 4, "uint64_t": 8,
+                                   "int8_t": 1, "int16_t": 2, "int32_t": 4, "int64_t": 8,
+                                   "float": 4, "double": 8, "bool": 1, "char": 1})
+_python_data_widths = MappingProxyType({int: 8, float: 8, bool: 1})
+data_widths = {**_c_data_widths, **_python_data_widths}
+@functools.lru_cache(maxsize=None)
 def get_data_width(data_type: Union[str, type]) -> Optional[int]:
     """
     Get the width of a data type in bytes
@@ -32,8 +36,13 @@ def get_data_width(data_type: Union[str, type]) -> Optional[int]:
     True
     >>> get_data_width(int)
     8
+    >>> get_data_width(" uint16_t ")
+    2
     """
-    return data_widths.get(data_type.strip(), None)
+    if not isinstance(data_type, str):
+        return _python_data_widths.get(data_type)
+    width = _c_data_widths.get(data_type)
+    return width if width is not None else _c_data_widths.get(data_type.strip())
 
 def common_prefix(lhs, rhs, max_length) -> int:
     """
@@ -49,7 +58,12 @@ def common_prefix(lhs, rhs, max_length) -> int:
     3
     >>> common_prefix("foobar", "foo", 1)
     1
+    >>> common_prefix("ab", "ababax", 6)
+    5
+    >>> common_prefix(b"ab", b"ababax", 6)
+    5
     """
+    # Only the doctests use this since LZSS moved to hash chains, it is kept as the plain reference loop.
     lhs_len = len(lhs)
     count = min(len(rhs), max_length)
     for i in range(count):
@@ -4,17 +4,19 @@
 #  LICENSE.txt in this repository file going up the directory tree.
 #
 
+import io
+import itertools
+import mmap
 import os.path
 import re
 import struct
 import sys
 
-import math
 from array import array
 from dataclasses import dataclass
 from fontTools.ttLib import TTFont
 from PIL import Image
-from typing import Tuple, Any, Iterable, Optional, Callable, Union
+from typing import Tuple, Any, Iterable, Optional, Callable, Union, TextIO
 
 from buffer_processor.process_controller import ProcessController
 from buffer_processor.bitstream import Bitstream
@@ -30,14 +32,15 @@ _buffer_line_re: re.Pattern[str] = re.compile(r"^\s*(?P<args>.*?)\s*(?P<end>\);)
 _value_re: re.Pattern[str] = re.compile(r"(?P<hex>0x[0-9a-fA-F]+)|(?P<int>[+-]?[0-9]+)|((?P<number>[+-]?[0-9]+)?\.(?P<decimal>[0-9]+)(?P<float>f)?)")
 _namespace_re: re.Pattern[str] = re.compile(r"namespace\s+(?P<namespace>[a-zA-Z0-9:_]+)\s*(\{)?")
 
-@dataclass
+# Slots keep instances small and attribute access direct, buffers are created and dispatched on in bulk.
+@dataclass(slots=True)
 class Buffer:
     namespace: str
     type: str
     name: str
     suffix: str
     args_str: str
-    source_data: Optional[Union[bytes, Image.Image, TTFont]] = None
+    source_data: Optional[Union[bytes, memoryview, Image.Image, TTFont]] = None
     target_data: Optional[list[int]] = None
     valid: bool = True
 
@@ -46,6 +49,9 @@ def analyze_file(inputfile, **defines) -> Iterable[Buffer]:
         namespace = None
         buffer = None
         for line_index, line in enumerate(filter_code(fd.readlines(), **defines)):
+            # Most lines declare nothing, rule them out with substring checks before running any of the patterns.
+            if buffer is None and "namespace" not in line and "Buffer(" not in line:
+                continue
             if match := _namespace_re.match(line):
                 namespace = match.group("namespace")
             elif match := _buffer_start_re.match(line):
@@ -56,9 +62,13 @@ def analyze_file(inputfile, **defines) -> Iterable[Buffer]:
                 if match.group("end") is not None:
                     yield buffer
                     buffer = None
+                else:
+                    # Arguments spanning several lines are joined once the buffer is closed.
+                    args_parts = [buffer.args_str]
             elif buffer is not None and (match := _buffer_line_re.match(line)):
-                buffer.args_str += match.group("args")
+                args_parts.append(match.group("args"))
                 if match.group("end") is not None:
+                    buffer.args_str = "".join(args_parts)
                     yield buffer
                     buffer = None
 # </editor-fold>
@@ -90,18 +100,24 @@ cpp_multi_line_buffer_template = """    constexpr std::size_t ${name}_${suffix}S
 """
 cpp_buffer_line = """${data:keep_indent}"""
 
-def get_buffer_data(buffer: Buffer, data) -> Iterable[str]:
-    data_width = get_data_width(buffer.type)
-    for start_byte in range((len(data) + data_width - 1) // data_width):
-        value = 0
-        for i in range(data_width):
-            byte_index = start_byte * data_width + i
-            value <<= 8
-            if byte_index < len(data):
-                value |= data[byte_index]
-        fmt = f"0{data_width * 2}X"
-        yield f"0x{format(value, fmt)}"
+def get_buffer_data(buffer: Buffer, data, data_width: Optional[int] = None) -> Iterable[str]:
+    if data_width is None:
+        data_width = get_data_width(buffer.type)
+    # Values are big endian with the last one padded at the end, so each one is a slice of the hex string.
+    hex_data = (bytes(data) + bytes(-len(data) % data_width)).hex().upper()
+    hex_width = data_width * 2
+    for start in range(0, len(hex_data), hex_width):
+        yield "0x" + hex_data[start:start + hex_width]
+def join_buffer_data(buffer: Buffer, data, data_width: Optional[int] = None) -> str:
+    # The values of get_buffer_data joined by ", ", bytes.hex groups the digits per value by itself.
+    if data_width is None:
+        data_width = get_data_width(buffer.type)
+    hex_data = (bytes(data) + bytes(-len(data) % data_width)).hex(",", data_width).upper()
+    return "0x" + hex_data.replace(",", ", 0x") if len(hex_data) > 0 else ""
 def generate_buffers(namespace: str, buffers: Iterable[Buffer], max_line_length: int) -> Iterable[str]:
+    # The line template is the same for every line, so it is applied once around a marker for the data.
+    marker = "\0data\0"
+    line_prefix, line_suffix = apply_placeholders(cpp_buffer_line, data=marker).split(marker)
     for buffer in buffers:
         if buffer.namespace == namespace:
             # Assuming the declaration is worth about 4 values no matter what type
@@ -110,15 +126,15 @@ def generate_buffers(namespace: str, buffers: Iterable[Buffer], max_line_length:
             # Base per value is 2 characters, overhead per value is 2 chars for comma and 2 for 0x.
             max_values = max_line_length // (data_width * 2 + 4) * (data_width * 2)
             if len(buffer.target_data) < max_values - 4:
-                buffer_data = ", ".join(get_buffer_data(buffer, buffer.target_data))
+                buffer_data = join_buffer_data(buffer, buffer.target_data, data_width)
                 yield apply_placeholders(cpp_single_line_buffer_template, type=buffer.type, name=buffer.name, suffix=buffer.suffix, size=value_count, data=buffer_data)
             else:
                 buffer_lines = []
                 for i in range(0, len(buffer.target_data), max_values):
-                    buffer_data = ", ".join(get_buffer_data(buffer, buffer.target_data[i:i + max_values]))
+                    buffer_data = join_buffer_data(buffer, buffer.target_data[i:i + max_values], data_width)
                     if i + max_values < len(buffer.target_data):
                         buffer_data += ","
-                    buffer_lines.append(apply_placeholders(cpp_buffer_line, data=buffer_data))
+                    buffer_lines.append(line_prefix + buffer_data + line_suffix)
                 buffer_lines_str = "\n".join(buffer_lines)
                 yield apply_placeholders(cpp_multi_line_buffer_template, type=buffer.type, name=buffer.name, suffix=buffer.suffix, size=value_count, cpp_buffer_lines=buffer_lines_str)
 def generate_namespaces(buffers: Iterable[Buffer], max_line_length: int) -> Iterable[str]:
@@ -127,16 +143,28 @@ def generate_namespaces(buffers: Iterable[Buffer], max_line_length: int) -> Iter
     for namespace in namespaces:
         buffers_str = "".join(generate_buffers(namespace, buffer_list, max_line_length))
         yield apply_placeholders(cpp_namespace_template, namespace=namespace, cpp_buffers=buffers_str)
+def write_source_file(fd: TextIO, buffers: Iterable[Buffer], max_line_length: int) -> None:
+    buffer_list = list(buffers)
+    incomplete: str = cpp_incomplete_header if any(not buffer.valid for buffer in buffer_list) else ""
+    # Namespaces are written as they are generated instead of being joined into the whole file first, the header
+    # is split around a marker in their place.
+    marker = "\0cpp_namespaces\0"
+    prefix, suffix = apply_placeholders(cpp_header_file_template, cpp_namespaces=marker, incomplete=incomplete).split(marker)
+    fd.write(prefix)
+    for namespace in generate_namespaces(buffer_list, max_line_length):
+        fd.write(namespace)
+    fd.write(suffix)
 def generate_source_file(buffers: Iterable[Buffer], max_line_length: int) -> str:
-    cpp_namespaces: str = "".join(generate_namespaces(buffers, max_line_length))
-    incomplete: str = cpp_incomplete_header if any(not buffer.valid for buffer in buffers) else ""
-    return apply_placeholders(cpp_header_file_template, cpp_namespaces=cpp_namespaces, incomplete=incomplete)
+    output = io.StringIO()
+    write_source_file(output, buffers, max_line_length)
+    return output.getvalue()
 #</editor-fold>
 
 # <editor-fold desc="Data Sources">
+_value_formats = {1: "B", 2: "H", 4: "I", 8: "Q"}
 def generate_data(buffer: Buffer, args: str) -> None:
     data_bytes = get_data_width(buffer.type)
-    data: bytearray = bytearray()
+    values: list[int] = []
     for entry in args:
         entry = entry.strip().strip("\"'")
         match = _value_re.match(entry)
@@ -150,32 +178,23 @@ def generate_data(buffer: Buffer, args: str) -> None:
             value = float(entry)
         else:
             raise Exception(f"Invalid data entry {entry}")
+        values.append(value)
 
-        if data_bytes == 1:
-            data.append(value & 0xFF)
-        elif data_bytes == 2:
-            data.append((value >> 8) & 0xFF)
-            data.append(value & 0xFF)
-        elif data_bytes == 4:
-            data.append((value >> 24) & 0xFF)
-            data.append((value >> 16) & 0xFF)
-            data.append((value >> 8) & 0xFF)
-            data.append(value & 0xFF)
-        elif data_bytes == 8:
-            data.append((value >> 56) & 0xFF)
-            data.append((value >> 48) & 0xFF)
-            data.append((value >> 40) & 0xFF)
-            data.append((value >> 32) & 0xFF)
-            data.append((value >> 24) & 0xFF)
-            data.append((value >> 16) & 0xFF)
-            data.append((value >> 8) & 0xFF)
-            data.append(value & 0xFF)
-    buffer.source_data = bytes(data)
+    if data_bytes in _value_formats:
+        mask = (1 << (data_bytes * 8)) - 1
+        data = struct.pack(f">{len(values)}{_value_formats[data_bytes]}", *(value & mask for value in values))
+    else:
+        data = bytes()
+    buffer.source_data = data
     print (f"Generated Data {buffer.name} from C++ declaration with {len(data)} bytes.")
 def load_data(buffer: Buffer, path, *search_paths: str) -> None:
     try:
         with open(find_path(path, *search_paths), "rb") as fd:
-            buffer.source_data = fd.read()
+            # Mapping the file avoids reading a copy of it, the mapping stays valid after the file is closed.
+            if os.fstat(fd.fileno()).st_size > 0:
+                buffer.source_data = memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                buffer.source_data = bytes()
             print (f"Loaded Data {buffer.name} from {path} with {len(buffer.source_data)} bytes.")
     except Exception as e:
         print(f"{e}", file=sys.stderr)
@@ -214,6 +233,9 @@ def parse_args(args_str: str, *types: Any) -> Union[Tuple, Any]:
     if len(args) == len(types):
         return tuple(t(arg) for arg, t in zip(args, types))
     raise Exception(f"Invalid number of arguments {args_str}")
+def apply_defines(text: str, defines: dict[str, str]) -> str:
+    # Most arguments and paths contain no placeholders at all, apply_placeholders only sees those that do.
+    return apply_placeholders(text, **defines) if "${" in text else text
 def find_path(path: str, *search_paths: str) -> str:
     path = path.strip().strip("\"'")
     if os.path.isfile(path):
@@ -223,59 +245,93 @@ def find_path(path: str, *search_paths: str) -> str:
         if os.path.isfile(full_path):
             return full_path
     raise Exception(f"Failed to find data file {path}")
-def process_buffers(buffers: Iterable[Buffer], search_paths: Union[list[str], tuple[str]], **defines) -> Iterable[Buffer]:
-    for buffer in buffers:
-        buffer.args_str = buffer.args_str.strip()
-        buffer.args_str = apply_placeholders(buffer.args_str, **defines)
-
-        if buffer.suffix == "FixedFont":
-            offset, count, width, height, bits, color_type, path = parse_args(buffer.args_str, int, int, int, int, int, str, str)
-            load_image(buffer, path, *search_paths)
-            generate_fixed_font(buffer, color_type, count, width, height, bits)
-        elif buffer.suffix == "VariableFont":
-            offset, count, height, bits, color_type, path = parse_args(buffer.args_str, int, int, int, int, str, str)
-            load_image(buffer, path, *search_paths)
-            generate_variable_font(buffer, color_type, count, height, bits)
-        elif buffer.suffix == "Mpff":
-            path = parse_args(buffer.args_str, str)
-            load_font(buffer, path, *search_paths)
-            generate_mpff(buffer)
-        elif buffer.suffix == "Compressed":
-            compression, data = parse_args(buffer.args_str, str, list)
-            if len(data) > 1:
-                generate_data(buffer, data)
-            else:
-                load_data(buffer, data[0], *search_paths)
-            compress_buffer(buffer, compression)
-        elif buffer.suffix == "Jtag":
-            stream_type, compression, path = parse_args(buffer.args_str, str, str, str)
-            load_jtag(buffer, stream_type, path, *search_paths)
-            if compression.lower() == "none":
-                buffer.target_data = buffer.source_data
-            else:
-                compress_buffer(buffer, compression)
-        elif buffer.suffix == "Image":
-            format, path = parse_args(buffer.args_str, str, str)
-            load_image(buffer, path, *search_paths)
-            compress_image(buffer, format)
-        elif buffer.suffix == "Data":
-            path = parse_args(buffer.args_str, str)
-            load_data(buffer, path, *search_paths)
-            print(f"Using Data {buffer.name} unchanged.")
-            buffer.target_data = buffer.source_data
-        else:
-            raise Exception(f"Unknown buffer type {buffer.suffix}")
-        yield buffer
+def process_fixed_font(buffer: Buffer, search_paths: Union[list[str], tuple[str]], cache_path: Optional[str], max_threads: int) -> None:
+    offset, count, width, height, bits, color_type, path = parse_args(buffer.args_str, int, int, int, int, int, str, str)
+    load_image(buffer, path, *search_paths)
+    generate_fixed_font(buffer, color_type, count, width, height, bits)
+def process_variable_font(buffer: Buffer, search_paths: Union[list[str], tuple[str]], cache_path: Optional[str], max_threads: int) -> None:
+    offset, count, height, bits, color_type, path = parse_args(buffer.args_str, int, int, int, int, str, str)
+    load_image(buffer, path, *search_paths)
+    generate_variable_font(buffer, color_type, count, height, bits)
+def process_mpff(buffer: Buffer, search_paths: Union[list[str], tuple[str]], cache_path: Optional[str], max_threads: int) -> None:
+    path = parse_args(buffer.args_str, str)
+    load_font(buffer, path, *search_paths)
+    generate_mpff(buffer)
+def process_compressed(buffer: Buffer, search_paths: Union[list[str], tuple[str]], cache_path: Optional[str], max_threads: int) -> None:
+    compression, data = parse_args(buffer.args_str, str, list)
+    if len(data) > 1:
+        generate_data(buffer, data)
+    else:
+        load_data(buffer, data[0], *search_paths)
+    compress_buffer(buffer, compression, cache_path, max_threads)
+def process_jtag(buffer: Buffer, search_paths: Union[list[str], tuple[str]], cache_path: Optional[str], max_threads: int) -> None:
+    stream_type, compression, path = parse_args(buffer.args_str, str, str, str)
+    load_jtag(buffer, stream_type, path, *search_paths)
+    if compression.lower() == "none":
+        buffer.target_data = buffer.source_data
+    else:
+        compress_buffer(buffer, compression, cache_path, max_threads)
+def process_image(buffer: Buffer, search_paths: Union[list[str], tuple[str]], cache_path: Optional[str], max_threads: int) -> None:
+    format, path = parse_args(buffer.args_str, str, str)
+    load_image(buffer, path, *search_paths)
+    compress_image(buffer, format)
+def process_data(buffer: Buffer, search_paths: Union[list[str], tuple[str]], cache_path: Optional[str], max_threads: int) -> None:
+    path = parse_args(buffer.args_str, str)
+    load_data(buffer, path, *search_paths)
+    print(f"Using Data {buffer.name} unchanged.")
+    buffer.target_data = buffer.source_data
+_buffer_processors: dict[str, Callable[[Buffer, Union[list[str], tuple[str]], Optional[str], int], None]] = {
+    "FixedFont": process_fixed_font,
+    "VariableFont": process_variable_font,
+    "Mpff": process_mpff,
+    "Compressed": process_compressed,
+    "Jtag": process_jtag,
+    "Image": process_image,
+    "Data": process_data,
+}
+def process_buffer(buffer: Buffer, search_paths: Union[list[str], tuple[str]], defines: dict[str, str], cache_path: Optional[str] = None, max_threads: int = 1) -> Buffer:
+    buffer.args_str = apply_defines(buffer.args_str.strip(), defines)
+
+    processor = _buffer_processors.get(buffer.suffix, None)
+    if processor is None:
+        raise Exception(f"Unknown buffer type {buffer.suffix}")
+    processor(buffer, search_paths, cache_path, max_threads)
+    # Only the target data is needed from here on, the source data may be an image, font or mapped file, that
+    # would have to be sent back to the main process.
+    if isinstance(buffer.target_data, memoryview):
+        buffer.target_data = bytes(buffer.target_data)
+    buffer.source_data = None
+    return buffer
+# Fewer buffers than this are processed in the main process, a worker pool takes longer to start than they do.
+_min_parallel_buffers = 3
+def process_buffers(buffers: Iterable[Buffer], search_paths: Union[list[str], tuple[str]], max_threads: int = float("inf"), cache_path: Optional[str] = None, **defines) -> Iterable[Buffer]:
+    # Buffers are independent of each other, so every one is processed by a worker, they are yielded in order.
+    # Workers search compression parameters inline, only buffers processed in the main process search in parallel.
+    buffers = list(buffers)
+    buffer_threads = min(max_threads, os.cpu_count() or 1, len(buffers)) if len(buffers) >= _min_parallel_buffers else 1
+    compression_threads = 1 if buffer_threads > 1 else min(max_threads, CompressionRunner.search_width)
+    controller = ProcessController(buffer_threads)
+    controller.register("process", process_buffer)
+    try:
+        futures = [controller.start("process", (buffer, search_paths, defines, cache_path, compression_threads)) for buffer in buffers]
+        for future in futures:
+            yield future.result()
+    finally:
+        controller.join_all()
 # </editor-fold>
 
 # <editor-fold desc="Font Data Generation">
-def get_font_value(color_type: str, color: Tuple[int, int, int, int]) -> int:
+def get_font_values(image: Image.Image, color_type: str) -> bytes:
+    # All font values of the image in row order, taken from the pixel data at once instead of per pixel.
     color_type = color_type.strip().strip("\"").lower()
     if color_type == "rgb":
-        return (color[0] + color[1] + color[2] + 2) // 3
+        return bytes((r + g + b + 2) // 3 for r, g, b, a in image.getdata())
     elif color_type == "a":
-        return color[3]
+        return image.getchannel("A").tobytes()
     raise Exception(f"Unknown color type {color_type}")
+# Maps font values to 1 for columns with any set pixel, so characters are runs of ones.
+_font_ink_table = bytes([0] + [1] * 255)
+_font_ink_re: re.Pattern[bytes] = re.compile(rb"\x01+")
 def generate_fixed_characters(image: Image.Image, width: int, height: int) -> Iterable[Image.Image]:
     characters_per_column = image.width // width
     characters_per_row = image.height // height
@@ -286,32 +342,30 @@ def generate_fixed_characters(image: Image.Image, width: int, height: int) -> It
             yield image.crop((offset_x, offset_y, offset_x + width, offset_y + height))
 def generate_variable_characters(image: Image.Image, color_type: str, height: int) -> Iterable[Image.Image]:
     characters_per_row = image.height // height
+    values = get_font_values(image, color_type) if characters_per_row > 0 else bytes()
     for row in range(characters_per_row):
         offset_y = row * height
-        offset_x = 0
-        in_character = False # looking for the first pixel
-        for x in range(image.width):
-            for y in range(height):
-                if get_font_value(color_type, image.getpixel((x, offset_y + y))) > 0:
-                    if not in_character:
-                        in_character = True  # found the first pixel
-                        offset_x = x
-                    break
-            else:
-                if in_character:
-                    in_character = False
-                    yield image.crop((offset_x, offset_y, x, offset_y + height))
+        # Or all lines of the row together, a column has a set pixel, if its byte is not zero.
+        columns = 0
+        for y in range(offset_y, offset_y + height):
+            columns |= int.from_bytes(values[y * image.width:(y + 1) * image.width], "big")
+        columns = columns.to_bytes(image.width, "big").translate(_font_ink_table)
+        for character in _font_ink_re.finditer(columns):
+            # A character is only complete, once an empty column follows it.
+            if character.end() < image.width:
+                yield image.crop((character.start(), offset_y, character.end(), offset_y + height))
 def generate_character_buffer(image: Image.Image, color_type: str, bits: int) -> array:
     # Writing the data in byte columns, as it is more efficient to store since fonts are usually higher than
     # wide and because then color sizes less than 8 bit have a chance to be copied in 1-2 operations.
     data = array("B")
     byte_end_mask = (8 // bits) - 1
     color_shift = 8 - bits
+    values = get_font_values(image, color_type) if image.width > 0 else bytes()
     for x in range(image.width):
         column = 0
         y = 0
-        for y in range(image.height):
-            color = get_font_value(color_type, image.getpixel((x, y))) >> color_shift
+        for y, value in enumerate(values[x::image.width]):
+            color = value >> color_shift
             bit_offset = (y & byte_end_mask) * bits
             column = (color << bit_offset) | column
             if (y & byte_end_mask) == byte_end_mask:
@@ -365,24 +419,25 @@ def generate_mpff(buffer: Buffer) -> None:
                 "outline": glyph.getCoordinates(glyf_table)
             }
 
-    data = array("B")
-    data.extend(b"MPFF")
-    data.extend(struct.pack("<H", len(glyph_data)))
-    for c, d in glyph_data.items():
-        coords = d["outline"][0]
-        data.extend(c.encode("utf-8"))
-        data.extend(struct.pack("<H", len(coords)))
-        for x, y in coords:
-            data.extend(struct.pack("<hh", x, y))
+    # The size of every glyph block is known up front, so the output is allocated once and filled in place.
+    glyphs = [(c.encode("utf-8"), d["outline"][0]) for c, d in glyph_data.items()]
+    data = array("B", bytes(6 + sum(len(encoded) + 2 + 4 * len(coords) for encoded, coords in glyphs)))
+    struct.pack_into("<4sH", data, 0, b"MPFF", len(glyph_data))
+    offset = 6
+    for encoded, coords in glyphs:
+        data[offset:offset + len(encoded)] = array("B", encoded)
+        offset += len(encoded)
+        struct.pack_into(f"<H{2 * len(coords)}h", data, offset, len(coords), *itertools.chain.from_iterable(coords))
+        offset += 2 + 4 * len(coords)
     buffer.target_data = data
     print(f"Generated MPFF Font {buffer.name} with {len(data)} bytes.")
 # </editor-fold>
 
 # <editor-fold desc="Compression">
-def compress_buffer(buffer: Buffer, compression_str: str) -> None:
+def compress_buffer(buffer: Buffer, compression_str: str, cache_path: Optional[str] = None, max_threads: int = 6) -> None:
     compression_type = compression_str.strip().strip("\"'").lower().split("_")
     compression = compression_type[0].lower()
-    if not isinstance(buffer.source_data, bytes):
+    if not isinstance(buffer.source_data, (bytes, memoryview)):
         buffer.source_data = bytes(buffer.source_data.tobytes())
     if compression == "lzss":
         if len(compression_type) == 3:
@@ -400,10 +455,11 @@ def compress_buffer(buffer: Buffer, compression_str: str) -> None:
                 max_length_bits = int(compression_type[3])
             elif len(compression_type) > 2:
                 raise Exception(f"Invalid LZSS compression type {compression_str}")
-            max_threads = 6
             runner = CompressionRunner(LZSSCodec, buffer.source_data, max_window_bits, max_length_bits, max_threads)
+            runner.cache_path = cache_path
             buffer.target_data, result = runner.find_best_compression()
-            print(f"Compressed {buffer.name} with window {result.window_bits} and length {result.length_bits} to {len(buffer.target_data)} bytes.")
+            cached = " cached" if result.pass_count < 1 else ""
+            print(f"Compressed {buffer.name} with{cached} window {result.window_bits} and length {result.length_bits} to {len(buffer.target_data)} bytes.")
         else:
             raise Exception(f"Invalid LZSS compression type {compression_str}")
     elif compression == "rle":
@@ -440,6 +496,72 @@ def pixel_to_r1(r: int, g: int, b: int, a: int) -> tuple[int, int]:
     return 1, r + g + b > 384
 def pixel_to_a1(r: int, g: int, b: int, a: int) -> tuple[int, int]:
     return 1, 1 if a > 0 else 0
+# Converting all pixels at once, the RGBA data of an image is a single integer with a 32 bit lane per pixel, that
+# is masked and shifted with lane masks, values only move towards the low end of their own lane.
+def _lane_mask(mask: int, count: int) -> int:
+    return int.from_bytes(mask.to_bytes(4, "big") * count, "big")
+def _lanes_to_bytes(lanes: int, count: int, width: int) -> bytes:
+    # Keeps the low width bytes of every lane.
+    data = lanes.to_bytes(count * 4, "big")
+    result = bytearray(count * width)
+    for index in range(width):
+        result[index::width] = data[4 - width + index::4]
+    return bytes(result)
+def _digits_to_bytes(digits: bytes, bits: int) -> bytes:
+    # Sub byte values are written as one digit each and parsed in one go, padded at the end like a Bitstream.
+    digits += b"0" * (-len(digits) % (8 // bits))
+    return int(digits, 1 << bits).to_bytes(len(digits) * bits // 8, "big") if len(digits) > 0 else b""
+_digit_table = b"0123456789ABCDEF" + b"0" * 240
+_nibble_digit_table = bytes(_digit_table[value >> 4] for value in range(256))
+_flag_digit_table = b"0" + b"1" * 255
+def _pixel_sum_lanes(pixels: int, count: int, bias: int) -> int:
+    # r + g + b + bias per lane, at most 10 bits, so lanes do not carry into each other.
+    low_byte = _lane_mask(0x000000FF, count)
+    return ((pixels >> 24) & low_byte) + ((pixels >> 16) & low_byte) + ((pixels >> 8) & low_byte) + _lane_mask(bias, count)
+def pixels_to_rgba8888(data: bytes) -> bytes:
+    return bytes(data)
+def pixels_to_rgb888(data: bytes) -> bytes:
+    result = bytearray(len(data) // 4 * 3)
+    for index in range(3):
+        result[index::3] = data[index::4]
+    return bytes(result)
+def pixels_to_r4(data: bytes) -> bytes:
+    count = len(data) // 4
+    # (r + g + b + 2) // 3 >> 4 is (r + g + b + 2) // 48, which is the same as * 683 >> 15 for all sums.
+    lanes = ((_pixel_sum_lanes(int.from_bytes(data, "big"), count, 2) * 683) >> 15) & _lane_mask(0x0000000F, count)
+    return _digits_to_bytes(_lanes_to_bytes(lanes, count, 1).translate(_digit_table), 4)
+def pixels_to_a4(data: bytes) -> bytes:
+    return _digits_to_bytes(data[3::4].translate(_nibble_digit_table), 4)
+def pixels_to_r1(data: bytes) -> bytes:
+    count = len(data) // 4
+    # Bit 9 of r + g + b + 127 is set exactly for sums above 384.
+    lanes = (_pixel_sum_lanes(int.from_bytes(data, "big"), count, 127) >> 9) & _lane_mask(0x00000001, count)
+    return _digits_to_bytes(_lanes_to_bytes(lanes, count, 1).translate(_digit_table), 1)
+def pixels_to_a1(data: bytes) -> bytes:
+    return _digits_to_bytes(data[3::4].translate(_flag_digit_table), 1)
+def pixels_to_rgb565(data: bytes) -> bytes:
+    count = len(data) // 4
+    pixels = int.from_bytes(data, "big")
+    lanes = (((pixels & _lane_mask(0xF8000000, count)) >> 16) | ((pixels & _lane_mask(0x00FC0000, count)) >> 13)
+             | ((pixels & _lane_mask(0x0000F800, count)) >> 11))
+    return _lanes_to_bytes(lanes, count, 2)
+def pixels_to_rgba4444(data: bytes) -> bytes:
+    count = len(data) // 4
+    pixels = int.from_bytes(data, "big")
+    lanes = (((pixels & _lane_mask(0xF0000000, count)) >> 16) | ((pixels & _lane_mask(0x00F00000, count)) >> 12)
+             | ((pixels & _lane_mask(0x0000F000, count)) >> 8) | ((pixels & _lane_mask(0x000000F0, count)) >> 4))
+    return _lanes_to_bytes(lanes, count, 2)
+def pixels_to_rgab5515(data: bytes) -> bytes:
+    count = len(data) // 4
+    pixels = int.from_bytes(data, "big")
+    # Any set alpha bit is folded down to the lowest one, which then becomes the 0x20 flag.
+    alpha = pixels & _lane_mask(0x000000FF, count)
+    alpha |= alpha >> 4
+    alpha |= alpha >> 2
+    alpha |= alpha >> 1
+    lanes = (((pixels & _lane_mask(0xF8000000, count)) >> 16) | ((pixels & _lane_mask(0x00F80000, count)) >> 13)
+             | ((pixels & _lane_mask(0x0000F800, count)) >> 11) | ((alpha & _lane_mask(0x00000001, count)) << 5))
+    return _lanes_to_bytes(lanes, count, 2)
 def image_to_bitmap(image: Image.Image, *args: str) -> array:
     if len(args) < 1:
         format = "rgb565"
@@ -452,24 +574,18 @@ def image_to_bitmap(image: Image.Image, *args: str) -> array:
     if format_converter is None:
         raise Exception(f"Unknown pixel format {format}")
 
+    batch_converter: Optional[Callable[[bytes], bytes]] = globals().get(f"pixels_to_{format}", None)
+    if batch_converter is not None and image.mode == "RGBA":
+        return array("B", batch_converter(image.tobytes()))
     data = Bitstream()
-    for y in range(height):
-        for x in range(width):
-            r, g, b, a = image.getpixel((x, y))
-            data.append(*format_converter(r, g, b, a))
+    for r, g, b, a in image.getdata():
+        data.append(*format_converter(r, g, b, a))
     return data.to_array()
 def bc1_compress_block(block: list[Tuple[int, int, int, int]]) -> array:
     has_alpha = any(a < 255 for r, g, b, a in block)
-    max_r, max_g, max_b = (0, 0, 0)
-    min_r, min_g, min_b = (255, 255, 255)
-
-    for r, g, b, a in block:
-        min_r = min(min_r, r)
-        min_g = min(min_g, g)
-        min_b = min(min_b, b)
-        max_r = max(max_r, r)
-        max_g = max(max_g, g)
-        max_b = max(max_b, b)
+    reds, greens, blues, alphas = zip(*block)
+    min_r, min_g, min_b = min(reds), min(greens), min(blues)
+    max_r, max_g, max_b = max(reds), max(greens), max(blues)
 
     colors = [(max_r, max_g, max_b)]
     colors.append((min_r, min_g, min_b))
@@ -481,26 +597,22 @@ def bc1_compress_block(block: list[Tuple[int, int, int, int]]) -> array:
         colors.append(((min_r + max_r) // 3, (min_g + max_g) // 3, (min_b + max_b) // 3))
         colors.append((((min_r + max_r) * 2) // 3, ((min_g + max_g) * 2) // 3, ((min_b + max_b) * 2) // 3))
 
-    data = Bitstream()
+    # The 2 bit indices of all pixels and both 16 bit end points make up the 8 bytes of the block.
+    palette = colors[:-1] if has_alpha else colors
+    indices = 0
     for r, g, b, a in block:
         if has_alpha and a < 128:
-            data.append(2, 3)
+            index = 3
         else:
-            best_distance = float("inf")
-            best_index = 0
-            for i, color in enumerate(colors[:-1] if has_alpha else colors):
-                distance = sum((c1 - c2) ** 2 for c1, c2 in zip((r, g, b), color))
-                if distance < best_distance:
-                    best_distance = distance
-                    best_index = i
-            data.append(2, best_index)
-    color0 = pixel_to_rgb565(*colors[0] + tuple([0]))
-    color1 = pixel_to_rgb565(*colors[1] + tuple([0]))
-    data.append(*color0)
-    data.append(*color1)
-    return data.to_array()
+            distances = [(r - pr) * (r - pr) + (g - pg) * (g - pg) + (b - pb) * (b - pb) for pr, pg, pb in palette]
+            index = distances.index(min(distances))
+        indices = (indices << 2) | index
+    color0 = pixel_to_rgb565(*colors[0], 0)[1]
+    color1 = pixel_to_rgb565(*colors[1], 0)[1]
+    return array("B", ((indices << 32) | (color0 << 16) | color1).to_bytes(8, "big"))
 def image_to_bc1(image: Image.Image) -> array:
     width, height = image.size
+    pixels = list(image.getdata())
     data = array("B")
     for y in range(0, height, 4):
         for x in range(0, width, 4):
@@ -508,10 +620,9 @@ def image_to_bc1(image: Image.Image) -> array:
             for yb in range(4):
                 for xb in range(4):
                     if x + xb < width and y + yb < height:
-                        r, g, b, a = image.getpixel((x + xb, y + yb))
+                        block.append(pixels[(y + yb) * width + x + xb])
                     else:
-                        r, g, b, a = 0, 0, 0, 0
-                    block.append((r, g, b, a))
+                        block.append((0, 0, 0, 0))
             data.extend(bc1_compress_block(block))
     return data
 def compress_image(buffer: Buffer, format: str) -> None:
@@ -550,6 +661,11 @@ _jtag_runtest_re: re.Pattern[str] = re.compile(r"^\s*(?P<cmd>RUNTEST)\s+(?P<stat
 _jtag_cmd_re: re.Pattern[str] = re.compile(r"^\s*(?P<cmd>(SIR)|(SDR)|(HIR)|(HDR)|(TIR)|(TDR))\s+(?P<bits>[0-9]+)((\s*(?P<end>;)\s*)|(\s+(?P<args>.*)))$")
 _jtag_cmd_arg_re: re.Pattern[str] = re.compile(r"^\s*(?P<pin>(TDI)|(TDO)|(MASK))\s+\(\s*(?P<data>.+)$")
 _jtag_cmd_arg_data_re: re.Pattern[str] = re.compile(r"^\s*(?P<data>[0-9A-Za-z]+)\s*(?P<closing>\))?\s*(?P<end>;)?\s*$")
+# The keyword of a line selects the one pattern, that can match it, instead of trying them all in turn. Every line
+# of the file is one match, lines without a keyword, like command arguments, have no kind.
+_jtag_line_re: re.Pattern[str] = re.compile(r"^[^\S\n]*(?:(?P<skip>(?:!.*)?$)|(?P<state>STATE\b)|(?P<end>(?:ENDDR|ENDIR)\b)|(?P<frequency>FREQUENCY\b)|(?P<runtest>RUNTEST\b)|(?P<cmd>(?:SIR|SDR|HIR|HDR|TIR|TDR)\b))?.*$", re.MULTILINE)
+_jtag_line_patterns: dict[str, re.Pattern[str]] = {"skip": _jtag_skip_line_re, "state": _jtag_state_re, "end": _jtag_end_re,
+                                                   "frequency": _jtag_frequency_re, "runtest": _jtag_runtest_re, "cmd": _jtag_cmd_re}
 _jtag_commands = {"STATE": 0x01, "HDR": 0x02, "HIR": 0x03, "TDR": 0x04, "TIR": 0x05, "ENDDR": 0x06,
                   "ENDIR": 0x07, "FREQUENCY": 0x08, "RUNTEST": 0x0B, "SIR": 0x0D, "SDR": 0x0E}
 _jtag_states = {"RESET": 0x01, "IDLE": 0x02, "DRPAUSE": 0x03, "IRPAUSE": 0x04}
@@ -557,34 +673,27 @@ _jtag_args = {"TDI": 0x0C, "TDO": 0x0D, "MASK": 0x0E}
 # </editor-fold>
 # <editor-fold desc="JTAG Data Generation">
 def emit_state(data: array, state: str) -> None:
-    data.append(_jtag_commands["STATE"])
-    data.append(_jtag_states[state])
+    data.extend((_jtag_commands["STATE"], _jtag_states[state]))
 def emit_end_command(data: array, command: str, instr: str) -> None:
-    data.append(_jtag_commands[command])
-    data.append(_jtag_states[instr])
-def emit_frequency(data: array, number: int, decimal: int, negative: bool, exponent: int) -> None:
-    data.append(_jtag_commands["FREQUENCY"])
-    frequency = math.floor(float(f"{number}.{decimal}") * 10 ** (exponent * (-1 if negative else 1)))
-    data.append((frequency >> 24) & 0xFF)
-    data.append((frequency >> 16) & 0xFF)
-    data.append((frequency >> 8) & 0xFF)
-    data.append(frequency & 0xFF)
-def emit_runtest(data: array, state: str, edges: int, number: int, decimal: int, negative: bool, exponent: int) -> None:
-    data.append(_jtag_commands["RUNTEST"])
-    data.append(_jtag_states[state])
-    data.append(edges >> 8)
-    data.append(edges & 0xFF)
-    time = math.floor(float(f"{number}.{decimal}") * 10 ** (exponent * (-1 if negative else 1)) * 10000000)
-    data.append((time >> 24) & 0xFF)
-    data.append((time >> 16) & 0xFF)
-    data.append((time >> 8) & 0xFF)
-    data.append(time & 0xFF)
+    data.extend((_jtag_commands[command], _jtag_states[instr]))
+def parse_jtag_number(number_str: str, exponent_offset: int = 0) -> Optional[int]:
+    # The number times 10 ** exponent_offset rounded down, computed on the digits as integers, so neither leading
+    # zeros of the decimals nor float rounding change the result. None if the format is invalid.
+    number_match = _jtag_number_re.match(number_str)
+    if number_match is None:
+        return None
+    number, decimal, direction, exponent = number_match.group("number", "decimal", "dir", "exp")
+    exponent = (-int(exponent) if direction == "-" else int(exponent)) + exponent_offset - len(decimal)
+    value = int(number + decimal)
+    return value * 10 ** exponent if exponent >= 0 else value // 10 ** -exponent
+def emit_frequency(data: array, frequency: int) -> None:
+    data.frombytes(struct.pack(">BI", _jtag_commands["FREQUENCY"], frequency & 0xFFFFFFFF))
+def emit_runtest(data: array, state: str, edges: int, time: int) -> None:
+    # The time is in units of 100ns.
+    data.frombytes(struct.pack(">BBHI", _jtag_commands["RUNTEST"], _jtag_states[state], edges, time & 0xFFFFFFFF))
 def emit_command(data: array, command: str, bits: int, *args: tuple[str, str]) -> None:
     data.append(_jtag_commands[command])
-    data.append((bits >> 24) & 0xFF)
-    data.append((bits >> 16) & 0xFF)
-    data.append((bits >> 8) & 0xFF)
-    data.append(bits & 0xFF)
+    data.frombytes(struct.pack(">I", bits & 0xFFFFFFFF))
 
     # We are inverting the args, so we receive the big buffer to send last in the loader
     # implementation on the firmware side and use it to trigger the transfer. Since we
@@ -592,14 +701,12 @@ def emit_command(data: array, command: str, bits: int, *args: tuple[str, str]) -
     args = sorted(args, key=lambda arg: _jtag_args[arg[0]], reverse=True)
     for arg, value in args:
         data.append(_jtag_args[arg])
-        length = len(value)
-        byte_length = (length + 1) // 2
-        data.append((byte_length >> 24) & 0xFF)
-        data.append((byte_length >> 16) & 0xFF)
-        data.append((byte_length >> 8) & 0xFF)
-        data.append(byte_length & 0xFF)
-        for i in range(0, len(value), 2):
-            data.append(int(value[i:i + 2], 16))
+        byte_length = (len(value) + 1) // 2
+        data.frombytes(struct.pack(">I", byte_length & 0xFFFFFFFF))
+        # Pairs of digits are bytes from the start, an odd digit at the end is a byte of its own.
+        data.frombytes(bytes.fromhex(value[:len(value) & ~1]))
+        if len(value) & 1:
+            data.append(int(value[-1], 16))
 # </editor-fold>
 
 def convert_svf_stream(buffer: Buffer, path, *search_paths: str) -> None:
@@ -609,7 +716,8 @@ def convert_svf_stream(buffer: Buffer, path, *search_paths: str) -> None:
             cmd_match: Optional[re.Match[str]] = None
             arg_matches: Optional[list[tuple[re.Match[str], Optional[str]]]] = None
             arg_match: Optional[re.Match[str]] = None
-            arg_data: Optional[str] = None
+            # Argument data may span many lines, it is collected in parts and joined once the argument is closed.
+            arg_data: Optional[list[str]] = None
             def _emit_cmd(data, cmd_match: re.Match[str], *arg_matches: Tuple[re.Match[str], str]) -> tuple[None, list]:
                 cmd = cmd_match.group("cmd")
                 bits = int(cmd_match.group("bits"))
@@ -619,25 +727,30 @@ def convert_svf_stream(buffer: Buffer, path, *search_paths: str) -> None:
                 emit_command(data, cmd, bits, *args)
                 return None, []
 
-            for i, line in enumerate(fd.readlines()):
-                line = line.strip()
-                if _jtag_skip_line_re.match(line):
+            for i, line_match in enumerate(_jtag_line_re.finditer(fd.read())):
+                line = line_match.group().strip()
+                line_kind = line_match.lastgroup
+                match = _jtag_line_patterns[line_kind].match(line) if line_kind is not None else None
+                if match is None:
+                    if cmd_match is None:
+                        raise Exception(f"{path}:{i}: Error: Unknown JTAG command '{line}'.")
+                elif line_kind == "skip":
                     pass
-                elif match := _jtag_state_re.match(line):
+                elif line_kind == "state":
                     emit_state(data, match.group("state"))
-                elif match := _jtag_end_re.match(line):
+                elif line_kind == "end":
                     emit_end_command(data, match.group("cmd"), match.group("instr"))
-                elif match := _jtag_frequency_re.match(line):
-                    number_match = _jtag_number_re.match(match.group("frequency"))
-                    if number_match is None:
+                elif line_kind == "frequency":
+                    frequency = parse_jtag_number(match.group("frequency"))
+                    if frequency is None:
                         raise Exception(f"{path}:{i}: Error: Invalid number format.")
-                    emit_frequency(data, int(number_match.group("number")), int(number_match.group("decimal")), number_match.group("dir") == "-", int(number_match.group("exp")))
-                elif match := _jtag_runtest_re.match(line):
-                    number_match = _jtag_number_re.match(match.group("time"))
-                    if number_match is None:
+                    emit_frequency(data, frequency)
+                elif line_kind == "runtest":
+                    time = parse_jtag_number(match.group("time"), 7)
+                    if time is None:
                         raise Exception(f"{path}:{i}: Error: Invalid number format.")
-                    emit_runtest(data, match.group("state"), int(match.group("edges")), int(number_match.group("number")), int(number_match.group("decimal")), number_match.group("dir") == "-", int(number_match.group("exp")))
-                elif match := _jtag_cmd_re.match(line):
+                    emit_runtest(data, match.group("state"), int(match.group("edges")), time)
+                elif line_kind == "cmd":
                     if cmd_match is not None:
                         raise Exception(f"{path}:{i}: Error: JTAG command {cmd_match.group('cmd')} incomplete.")
                     if match.group("end") is not None:
@@ -646,24 +759,26 @@ def convert_svf_stream(buffer: Buffer, path, *search_paths: str) -> None:
                         cmd_match = match
                         arg_matches = []
                         line = cmd_match.group("args")
-                elif cmd_match is None:
-                    raise Exception(f"{path}:{i}: Error: Unknown JTAG command '{line}'.")
-                if match := _jtag_cmd_arg_re.match(line):
-                    if arg_match is not None:
-                        raise Exception(f"{path}:{i}: Error: JTAG command {cmd_match.group('cmd')} has an incomplete argument in '{line}'.")
-                    arg_match = match
-                    arg_data = ""
-                    line = arg_match.group("data")
-                if match := _jtag_cmd_arg_data_re.match(line):
-                    arg_data += match.group("data")
-                    if match.group("closing") is not None:
-                        arg_matches.append((arg_match, arg_data))
-                        arg_match = None
-                        arg_data = None
-                        if match.group("end") is not None:
-                            cmd_match, arg_matches = _emit_cmd(data, cmd_match, *arg_matches)
-                    elif match.group("end") is not None:
-                        raise Exception(f"{path}:{i}: Error: JTAG command {cmd_match.group('cmd')} has an incomplete argument.")
+                # Only lines inside a command can hold arguments, all others are done with at this point.
+                if cmd_match is not None:
+                    if match := _jtag_cmd_arg_re.match(line):
+                        if arg_match is not None:
+                            raise Exception(f"{path}:{i}: Error: JTAG command {cmd_match.group('cmd')} has an incomplete argument in '{line}'.")
+                        arg_match = match
+                        arg_data = []
+                        line = arg_match.group("data")
+                    if match := _jtag_cmd_arg_data_re.match(line):
+                        if arg_data is None:
+                            raise Exception(f"{path}:{i}: Error: JTAG command {cmd_match.group('cmd')} has data outside of an argument.")
+                        arg_data.append(match.group("data"))
+                        if match.group("closing") is not None:
+                            arg_matches.append((arg_match, "".join(arg_data)))
+                            arg_match = None
+                            arg_data = None
+                            if match.group("end") is not None:
+                                cmd_match, arg_matches = _emit_cmd(data, cmd_match, *arg_matches)
+                        elif match.group("end") is not None:
+                            raise Exception(f"{path}:{i}: Error: JTAG command {cmd_match.group('cmd')} has an incomplete argument.")
     except Exception as e:
         print(f"{e}", file=sys.stderr)
         buffer.valid = False
@@ -677,10 +792,11 @@ def load_jtag(buffer: Buffer, input_type: str, path: str, *search_paths: str) ->
         raise Exception(f"Unknown JTAG input type {input_type}")
 # </editor-fold>
 
-def generate_buffer_files(inputfile: str, outputfile: str, compiler_args: CompilerArgs, max_values: int):
-    buffers: Iterable[Buffer] = process_buffers(analyze_file(inputfile, **compiler_args.defines), compiler_args.header_paths, **compiler_args.defines)
+def generate_buffer_files(inputfile: str, outputfile: str, compiler_args: CompilerArgs, max_values: int, max_threads: int = float("inf"), cache_path: Optional[str] = None):
+    # With a cache_path, the best LZSS parameters are kept between runs, so rebuilds of unchanged buffers skip the search.
+    buffers: Iterable[Buffer] = process_buffers(analyze_file(inputfile, **compiler_args.defines), compiler_args.header_paths, max_threads, cache_path, **compiler_args.defines)
     with open(outputfile, "w") as fd:
-        fd.write(generate_source_file(buffers, max_values))
+        write_source_file(fd, buffers, max_values)
 
 def filter_files(compiler_args: CompilerArgs) -> None:
     for inputfile in compiler_args.files:
@@ -690,12 +806,12 @@ def filter_files(compiler_args: CompilerArgs) -> None:
 def list_dependencies(compiler_args: CompilerArgs) -> None:
     for inputfile in compiler_args.files:
         for buffer in analyze_file(inputfile, **compiler_args.defines):
-            args = buffer.args_str.split(",")
-            if buffer.suffix == "Compressed" and len(args) != 2:
+            if buffer.suffix not in _buffer_processors:
                 continue
-            elif buffer.suffix not in ["Compressed", "FixedFont", "VariableFont", "Mpff", "Jtag", "Image", "Data"]:
+            # Compressed buffers only depend on a file, when they have exactly a compression and a path argument.
+            if buffer.suffix == "Compressed" and buffer.args_str.count(",") != 1:
                 continue
-            print(args[-1])
+            print(buffer.args_str.rsplit(",", 1)[-1])
 
 if __name__ == '__main__':
     ProcessController.boot()
@@ -704,19 +820,21 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Buffer Compressor')
     parser.add_argument('mode', choices=['generate', 'filter', 'deps'], help='Utility mode')
     parser.add_argument('--max-values', type=int, default=50, help='maximum number of values per line in the generated C++ header file')
+    parser.add_argument('-j', '--max-threads', type=int, default=None, help='maximum number of buffers processed in parallel, one per core by default')
+    parser.add_argument('--cache', default=None, help='JSON file keeping the best LZSS parameters between runs, no cache by default')
     parser.add_argument('-S', '--search', action='append', help='include path for data files')
     parser.add_argument('compiler_args', nargs=argparse.REMAINDER, help='Compiler arguments, including files (e.g., -DVAR=value)')
     args = parser.parse_args()
 
     compiler_args = parse_compiler_args(args.compiler_args)
-    compiler_args.header_paths.extend([apply_placeholders(arg, **args.defines) for arg in args.search] if args.search is not None else [])
+    compiler_args.header_paths.extend(apply_defines(arg, compiler_args.defines) for arg in args.search or ())
     if args.mode == 'generate':
         if len(compiler_args.files) != 2:
             print("Error: Need an input and an output file.", file=sys.stderr)
             sys.exit(1)
         print(compiler_args.files[0], compiler_args.files[1])
         compiler_args.header_paths.append(os.path.dirname(compiler_args.files[0]))
-        generate_buffer_files(compiler_args.files[0], compiler_args.files[1], compiler_args, args.max_values)
+        generate_buffer_files(compiler_args.files[0], compiler_args.files[1], compiler_args, args.max_values, args.max_threads or os.cpu_count() or 1, args.cache)
     elif args.mode == 'filter':
         filter_files(compiler_args)
     elif args.mode == 'deps':